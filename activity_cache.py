@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+'''
+Versioned, content-addressed cache of parsed activity data.
+
+Cache entries are keyed by a hash of the tcx file content (or of its path,
+modification time and size) together with a parser schema version. Zip
+archive members and gzipped files are keyed by their uncompressed content,
+like the plain file, see archive. A
+re-exported file or a change of the parser output thus never gets stale
+data, while unchanged files keep hitting the cache across upgrades.
+
+All entries live in one cache directory, given explicitly or through the
+PYGARMIN_CACHE_DIR environment variable. Writes go to a temporary file that
+is renamed into place, so an interrupted run never leaves a broken entry.
+
+Frames are stored as HDF5 files by default. The 'npy' format, chosen with
+the PYGARMIN_CACHE_FORMAT environment variable, stores one .npy file per
+column and a JSON header instead. Its columns are memory-mapped on load, so
+a cache hit costs almost nothing and only the columns that are used get
+read from disk.
+'''
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+import archive
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pygarmin')
+
+#: Storage formats of cached frames.
+FORMATS = ('hdf', 'npy')
+
+#: Extension of the header file of npy frames.
+NPY_HEADER = '.npy.json'
+
+#: Cache name of the content keys of compressed sources, by archive.crc_key.
+CONTENT_KEY_NAME = 'ContentKey'
+
+
+def get_cache_dir(cache_dir=None):
+    '''Return the cache directory to use, creating it if needed.'''
+    if cache_dir is None:
+        cache_dir = os.environ.get('PYGARMIN_CACHE_DIR', DEFAULT_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def file_key(filename, method='content'):
+    '''Hash identifying the current state of a file.
+
+    method='content' hashes the file bytes, method='stat' only the absolute
+    path, modification time and size, which avoids reading the file.
+    '''
+    h = hashlib.sha1()
+    if method == 'content':
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    elif method == 'stat':
+        st = os.stat(filename)
+        h.update('{0}:{1!r}:{2}'.format(os.path.abspath(filename),
+                                        st.st_mtime, st.st_size).encode())
+    else:
+        raise ValueError('Unknown cache key method: {0}'.format(method))
+    return h.hexdigest()
+
+
+def atomic_write(path, write):
+    '''Call write(tmpname) and move the finished file to path.'''
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmpname)
+        os.replace(tmpname, path)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def column_path(path, i):
+    '''Path of column i of the npy frame with header at path.'''
+    return '{0}.{1}.npy'.format(path[:-len(NPY_HEADER)], i)
+
+
+def write_columns(path, df):
+    '''Write df as one .npy file per column, and its JSON header to path.
+
+    The header is written last, a frame is complete once it exists.
+    '''
+    index, index_names = [], []
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        index_names = list(df.index.names)
+        df = df.reset_index()
+        index = [str(column) for column in df.columns[:len(index_names)]]
+    for i, column in enumerate(df.columns):
+        # Time zones are kept in the header, values are stored in UTC
+        values = df[column].values
+        if values.dtype == object:
+            raise TypeError('Cannot store object column {0} as npy'.format(
+                column))
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.save(f, values)
+        atomic_write(column_path(path, i), write)
+    header = {'columns': [str(column) for column in df.columns],
+              'dtypes': [str(dtype) for dtype in df.dtypes],
+              'index': index, 'index_names': index_names, 'nrows': len(df)}
+
+    def write_header(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(header, f)
+    atomic_write(path, write_header)
+
+
+def read_columns(path):
+    '''Frame written by write_columns, with memory-mapped columns.
+
+    The columns are copy-on-write maps of the column files, pages are only
+    read when the values are used.
+    '''
+    with open(path) as f:
+        header = json.load(f)
+    data = {}
+    for i, (column, dtype) in enumerate(zip(header['columns'],
+                                            header['dtypes'])):
+        values = np.load(column_path(path, i), mmap_mode='c')
+        series = pd.Series(values.view(np.ndarray), copy=False)
+        tz = getattr(pd.api.types.pandas_dtype(dtype), 'tz', None)
+        if tz is not None:
+            series = series.dt.tz_localize('UTC').dt.tz_convert(tz)
+        data[column] = series
+    df = pd.DataFrame(data, columns=header['columns'], copy=False)
+    if header['index']:
+        df = df.set_index(header['index'])
+        df.index.names = header['index_names']
+    return df
+
+
+class ActivityCache(object):
+    '''Cache of DataFrames and small JSON documents derived from tcx files.
+
+    Several named artifacts can be stored per source file. They all share the
+    key of the source file, and are invalidated together when it changes.
+    '''
+
+    def __init__(self, cache_dir=None, version=0, key='content', fmt=None):
+        self.cache_dir = get_cache_dir(cache_dir)
+        self.version = version
+        self.key_method = key
+        if fmt is None:
+            fmt = os.environ.get('PYGARMIN_CACHE_FORMAT', 'hdf')
+        if fmt not in FORMATS:
+            raise ValueError('Unknown cache format: {0}'.format(fmt))
+        self.fmt = fmt
+        self._keys = {}
+
+    def key(self, filename):
+        '''Cache key of filename, computed once per file state.
+
+        Members of zip archives, and gzipped files with the content method,
+        get the key of the plain file, see stream_key.
+        '''
+        path, member = archive.split(filename)
+        st = os.stat(path)
+        state = (os.path.abspath(path), member, st.st_mtime, st.st_size)
+        if state not in self._keys:
+            if member is not None or (self.key_method == 'content' and
+                                      archive.is_stream(filename)):
+                digest = self.stream_key(filename)
+            else:
+                digest = file_key(filename, self.key_method)
+            self._keys[state] = '{0}-v{1}'.format(digest, self.version)
+        return self._keys[state]
+
+    def stream_key(self, source):
+        '''Content hash of a zip member or gzipped file.
+
+        It is stored by the CRC32 and size of the content, see
+        archive.crc_key, so a source is only read the first time it is seen.
+        '''
+        crc_key = archive.crc_key(source)
+        if crc_key is not None:
+            d = self.load_key_json(crc_key, CONTENT_KEY_NAME)
+            if d is not None:
+                return d['key']
+        digest = archive.content_key(source)
+        if crc_key is not None:
+            self.store_key_json(crc_key, CONTENT_KEY_NAME, {'key': digest})
+        return digest
+
+    def path(self, filename, name='ActivityData', ext=None):
+        return self.key_path(self.key(filename), name, ext)
+
+    def key_path(self, key, name='ActivityData', ext=None):
+        if ext is None:
+            # Path of a frame, the header file for the npy format
+            ext = NPY_HEADER if self.fmt == 'npy' else '.h5'
+        return os.path.join(self.cache_dir, '{0}-{1}{2}'.format(key, name, ext))
+
+    def load(self, filename, name='ActivityData'):
+        '''Return the cached frame of filename, or None on a cache miss.'''
+        return self.load_key(self.key(filename), name)
+
+    def store(self, filename, df, name='ActivityData'):
+        self.store_key(self.key(filename), df, name)
+
+    def load_key(self, key, name='ActivityData'):
+        '''Return a cached frame by cache key, or None.'''
+        path = self.key_path(key, name)
+        if not os.path.exists(path):
+            return None
+        if self.fmt == 'npy':
+            return read_columns(path)
+        return pd.read_hdf(path, name)
+
+    def store_key(self, key, df, name='ActivityData'):
+        path = self.key_path(key, name)
+        if self.fmt == 'npy':
+            write_columns(path, df)
+        else:
+            atomic_write(path, lambda tmp: df.to_hdf(tmp, key=name, mode='w'))
+
+    def load_json(self, filename, name):
+        '''Return a cached JSON document of filename, or None.'''
+        return self.load_key_json(self.key(filename), name)
+
+    def store_json(self, filename, name, obj):
+        self.store_key_json(self.key(filename), name, obj)
+
+    def load_key_json(self, key, name):
+        '''Return a cached JSON document by cache key, or None.'''
+        path = self.key_path(key, name, '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def store_key_json(self, key, name, obj):
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(obj, f)
+        atomic_write(self.key_path(key, name, '.json'), write)
+
+    def get(self, filename, loader, name='ActivityData'):
+        '''Return the cached frame of filename, calling loader on a miss.'''
+        df = self.load(filename, name)
+        if df is None:
+            df = loader(filename)
+            self.store(filename, df, name)
+        return df
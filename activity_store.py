@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+Consolidated HDF5 store holding the trackpoints of a whole archive.
+
+Trackpoints are appended to one table per sport and year, e.g.
+/Running/y2015, with an ActivityId column. The /activities table indexes
+every activity by id, sport, start time, source file and number of points.
+Queries look up the index first and then only read the partitions and
+columns they need.
+'''
+import datetime
+import numpy as np
+import pandas as pd
+
+
+INDEX_KEY = 'activities'
+
+#: Length reserved for string columns of the HDF5 tables.
+ID_LENGTH = 64
+SPORT_LENGTH = 32
+SOURCE_LENGTH = 256
+
+#: Activity ids per query when selecting activities by id.
+MAX_SELECT_IDS = 30
+
+#: Rows read at a time by iter_chunks.
+CHUNKSIZE = 500000
+
+
+def partition_key(sport, year):
+    return '{0}/y{1}'.format(sport, year)
+
+
+def naive_utc(t):
+    '''Timestamp t as tz-naive UTC, for comparison with the index.'''
+    t = pd.Timestamp(t)
+    if t.tzinfo is not None:
+        t = t.tz_convert('UTC').tz_localize(None)
+    return t
+
+
+def date_range(datefilt):
+    '''Start and end of the period given by a YYYY[-MM[-DD]] prefix.
+
+    Returns (None, None) if datefilt is not such a date prefix.
+    '''
+    for fmt, step in (('%Y-%m-%d', 'D'), ('%Y-%m', 'M'), ('%Y', 'Y')):
+        try:
+            start = datetime.datetime.strptime(datefilt, fmt)
+        except ValueError:
+            continue
+        if step == 'D':
+            end = start + datetime.timedelta(days=1)
+        elif step == 'M':
+            end = start.replace(year=start.year + start.month // 12,
+                                month=start.month % 12 + 1)
+        else:
+            end = start.replace(year=start.year + 1)
+        return pd.Timestamp(start), pd.Timestamp(end)
+    return None, None
+
+
+class ActivityStore(object):
+    '''Partitioned trackpoint store with a date/sport activity index.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _open(self, mode='a'):
+        return pd.HDFStore(self.path, mode=mode, complevel=5,
+                           complib='blosc')
+
+    def activities(self, sport=None, start=None, end=None):
+        '''Index of stored activities, optionally filtered.
+
+        Activities of the given sport starting in [start, end) are returned.
+        '''
+        try:
+            with self._open('r') as store:
+                if '/' + INDEX_KEY not in store.keys():
+                    return self._empty_index()
+                index = store.select(INDEX_KEY)
+        except (IOError, OSError):
+            return self._empty_index()
+        mask = np.ones(len(index), dtype=bool)
+        if sport is not None:
+            mask &= (index['Sport'] == sport).values
+        if start is not None:
+            mask &= (index['StartTime'] >= naive_utc(start)).values
+        if end is not None:
+            mask &= (index['StartTime'] < naive_utc(end)).values
+        return index[mask]
+
+    @staticmethod
+    def _empty_index():
+        return pd.DataFrame(columns=['ActivityId', 'Sport', 'StartTime',
+                                     'Source', 'NPoints'])
+
+    def activity_ids(self):
+        return set(self.activities()['ActivityId'])
+
+    def superseded_ids(self):
+        '''Ids of activities whose source file was stored again later.
+
+        An edited file gets a new activity id, its old version stays in
+        the store.
+        '''
+        index = self.activities()
+        index = index[index['Source'] != '']
+        later = index.duplicated('Source', keep='last')
+        return set(index['ActivityId'][later])
+
+    def add(self, activity_id, sport, df, source=''):
+        '''Append the trackpoints of an activity to its partition.'''
+        start_time = naive_utc(df['Time'].iloc[0])
+        data = df.copy()
+        data.insert(0, 'ActivityId', activity_id)
+        entry = pd.DataFrame({'ActivityId': [activity_id],
+                              'Sport': [sport],
+                              'StartTime': [start_time],
+                              'Source': [source[-SOURCE_LENGTH:]],
+                              'NPoints': [len(df)]},
+                             columns=['ActivityId', 'Sport', 'StartTime',
+                                      'Source', 'NPoints'])
+        with self._open() as store:
+            store.append(partition_key(sport, start_time.year), data,
+                         format='table', data_columns=['ActivityId'],
+                         min_itemsize={'ActivityId': ID_LENGTH},
+                         index=False)
+            store.append(INDEX_KEY, entry, format='table',
+                         data_columns=['ActivityId', 'Sport', 'StartTime'],
+                         min_itemsize={'ActivityId': ID_LENGTH,
+                                       'Sport': SPORT_LENGTH,
+                                       'Source': SOURCE_LENGTH},
+                         index=False)
+
+    def iter_activities(self, sport=None, start=None, end=None, ids=None,
+                        columns=None):
+        '''Yield (activity_id, df) for the matching activities.
+
+        Only the partitions holding matching activities are read, and of
+        those only the requested columns. When ids names a few activities
+        of a partition, only their rows are selected.
+        '''
+        index = self.activities(sport, start, end)
+        sizes = None
+        if ids is not None:
+            # Number of activities of every partition
+            sizes = index.groupby([index['Sport'],
+                                   index['StartTime'].dt.year]).size()
+            index = index[index['ActivityId'].isin(list(ids))]
+        if len(index) == 0:
+            return
+        years = index['StartTime'].dt.year
+        with self._open('r') as store:
+            for (sport_, year), part in index.groupby([index['Sport'],
+                                                       years]):
+                wanted = set(part['ActivityId'])
+                cols = None
+                if columns is not None:
+                    cols = ['ActivityId'] + list(columns)
+                key = partition_key(sport_, year)
+                # Every query scans the ActivityId column, a full read is
+                # faster from about a quarter of the activities on
+                if sizes is not None and 4*len(wanted) < sizes[(sport_,
+                                                                  year)]:
+                    data = self._select_ids(store, key, sorted(wanted), cols)
+                else:
+                    data = store.select(key, columns=cols)
+                for activity_id, df in data.groupby('ActivityId',
+                                                    sort=False):
+                    if activity_id in wanted:
+                        df = df.drop('ActivityId', axis=1)
+                        yield activity_id, df.reset_index(drop=True)
+
+    @staticmethod
+    def _select_ids(store, key, ids, columns):
+        # Rows of the given activities, queried on the ActivityId data
+        # column in batches, PyTables conditions are limited in size
+        parts = []
+        for i in range(0, len(ids), MAX_SELECT_IDS):
+            batch = ids[i:i + MAX_SELECT_IDS]
+            parts.append(store.select(key, where='ActivityId in batch',
+                                      columns=columns))
+        return pd.concat(parts)
+
+    def iter_chunks(self, sport=None, start=None, end=None, columns=None,
+                    chunksize=CHUNKSIZE):
+        '''Yield trackpoints of the matching activities in chunks of rows.
+
+        Unlike iter_activities, memory use is bounded by chunksize and not
+        by the size of the partitions. Chunks have an ActivityId column.
+        '''
+        index = self.activities(sport, start, end)
+        if len(index) == 0:
+            return
+        years = index['StartTime'].dt.year
+        cols = None
+        if columns is not None:
+            cols = ['ActivityId'] + list(columns)
+        with self._open('r') as store:
+            for (sport_, year), part in index.groupby([index['Sport'],
+                                                       years]):
+                key = partition_key(sport_, year)
+                wanted = set(part['ActivityId'])
+                # Only filter when the partition holds other activities
+                everything = store.get_storer(key).nrows == \
+                    part['NPoints'].sum()
+                for chunk in store.select(key, columns=cols,
+                                          chunksize=chunksize):
+                    if not everything:
+                        chunk = chunk[chunk['ActivityId'].isin(wanted)]
+                    if len(chunk):
+                        yield chunk
+
+    def select(self, sport=None, start=None, end=None, columns=None):
+        '''All matching trackpoints as one frame with an ActivityId column.'''
+        frames = []
+        for activity_id, df in self.iter_activities(sport, start, end,
+                                                    columns=columns):
+            df.insert(0, 'ActivityId', activity_id)
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=['ActivityId'] + list(columns or []))
+        return pd.concat(frames, ignore_index=True)
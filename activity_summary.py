@@ -3,118 +3,192 @@
 Create a meso-scale report (figures, html document) of a Garmin activity.
 '''
 import sys
-import os
 import matplotlib
 matplotlib.use('agg')
-import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.transforms import Bbox
 import parse_tcx
+import decimate
+import instrument
 import numpy as np
-import datetime
 
 
-def statsbox(var,ax):
+def statsbox(df, var):
     VAR=df[var]
     VAR=VAR[VAR>0]
     #VAR=np.ma.masked_equal(VAR,0)
     VARmean = VAR.mean()
     VARmin = VAR.min()
     VARmax = VAR.max()
-    textstr = var + ':\nMin=%.2f\nMean=%.2f\nMax=%.2f'%(VARmin, VARmean, VARmax)
-    props = dict(boxstyle='round', alpha=0.5, color='w')
-    axes[ax[0],ax[1]].text(1.1, 0.5, textstr, transform=axes[ax[0],ax[1]].transAxes, fontsize=10,
-                verticalalignment='center', bbox=props)
-
-
-pd.options.display.mpl_style = 'default'
-
-
-#Path to tcx file assumed to be passed as cmd line argument
-filename = sys.argv[1]
-
-# Load TCX file activity data.
-# Then store it as a HDF5 file.
-# If HDF5 file already exists, load data from there.
-basename = filename[:-4]
-filename_df = basename + '.h5'
-if os.path.exists(filename_df):
-    print('Loading data from HDF5 file')
-    df = pd.read_hdf(filename_df, 'ActivityData')
-else:
-    df = parse_tcx.load_tcx_data(filename)
-    print('Storing data to HDF5 file: ', filename_df)
-    df.to_hdf(filename_df, 'ActivityData')
-
-# print(df)
-
-# Basic statistics as html document
-print('Basic statistics')
-df.describe().to_html(basename + '-statistics.html')
-
-df['Mins']=df['SecondsElapsed']/60
-
-# Plot heart rate data
-print('Heart rate plot')
-fig, axes = plt.subplots(4, 3, figsize=(15, 10))
-#axes[0,0].plot(df['Mins'], df['HeartRateBpm'],linewidth=0.8, alpha=0.5)
-axes[0,0].scatter(df['Mins'],df['HeartRateBpm'],c=df['HeartRateBpm'],s=80,vmin=50,vmax=200,marker='.',alpha=0.5)
-axes[0,0].set_ylabel('Heart rate [bpm]')
-axes[0,1].hist(df['HeartRateBpm'],bins=np.linspace(df['HeartRateBpm'].min(),df['HeartRateBpm'].max(),50))
-axes[0,1].set_xlabel('Heart rate [bpm]')
-statsbox('HeartRateBpm',[0,1])
-
-axes[1,0].plot(df['Mins'],df['Speed'],linewidth=0.8, alpha=0.5)
-axes[1,0].set_ylabel('Speed [km/h]')
-#axes[1,1].hist(df['Speed'])
-
-axes[1,1].scatter(df['Slope'],df['Speed'],c=df['HeartRateBpm'],s=60,vmin=50,vmax=200,marker='.',alpha=1)
-axes[1,1].set_xlabel('Slope')
-axes[1,1].set_ylabel('Speed')
-statsbox('Speed',[1,1])
-
-axes[2,0].plot(df['Mins'],df['Cadence'],linewidth=0.8, alpha=0.5, marker='.', linestyle='none',markersize=2)
-axes[2,0].set_ylabel('Cadence [spm]')
-Cad=df['Cadence']
-Cad=np.array(Cad[Cad>0])
-axes[2,1].hist(Cad,bins=np.linspace(Cad.min(),Cad.max(),50))
-axes[2,1].set_xlabel('Cadence')
-statsbox('Cadence',[2,1])
-
-#axes[3,0].plot(df['Mins'],df['AltitudeMeters'],linewidth=0.8, alpha=0.5)
-axes[3,0].scatter(df['Mins'],df['AltitudeMeters'],c=df['HeartRateBpm'],s=80,vmin=50,vmax=200,marker='.',alpha=0.5)
-axes[3,0].set_ylabel('Altitude [m]')
-axes[3,1].hist(df['AltitudeMeters'])
-axes[3,1].set_xlabel('Altitude')
-axes[3,0].set_xlabel('Minutes')
-statsbox('AltitudeMeters',[3,1])
-
-axes[0,2].set_axis_off()
-axes[1,2].set_axis_off()
-axes[2,2].set_axis_off()
-axes[3,2].set_axis_off()
-
-textstr = df['Time'].min().strftime('%d/%m/%Y %H:%M') + '-' + df['Time'].max().strftime('%H:%M')
-props = dict(boxstyle='round', alpha=0.5, color='w')
-axes[0,1].text(0.5, 1.2, textstr, transform=axes[0,1].transAxes, fontsize=12,
-            verticalalignment='center', bbox=props, fontweight='bold', horizontalalignment='center')
-
-Duration=df['Mins'].max()
-
-Eldiff=np.diff(df['AltitudeMeters'])
-
-ElGain=Eldiff[Eldiff>0]
-ElGain=ElGain.sum()
-
-ElLoss=np.abs(Eldiff[Eldiff<0])
-ElLoss=ElLoss.sum()
-
-textstr = 'Total time: %0.0f mins.\nElevation gain: %0.0f m\nElevation loss: %0.0f m'%(Duration, ElGain, ElLoss)
-props = dict(boxstyle='round', alpha=0.5, color='w')
-axes[2,2].text(0.5, 0.5, textstr, transform=axes[2,2].transAxes, fontsize=12,
-            verticalalignment='center', bbox=props, fontweight='bold', horizontalalignment='left')
-
-for i in range(4):
-    axes[i,0].set_xlim(0,df['Mins'].max())
-
-plt.savefig(basename + '-ActivitySummary.png')
-plt.close()
+    return var + ':\nMin=%.2f\nMean=%.2f\nMax=%.2f'%(VARmin, VARmean, VARmax)
+
+
+def set_hist(bars, values, bins):
+    '''Redraw histogram bars for new values.'''
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        values = np.zeros(1)
+    counts, edges = np.histogram(values, bins)
+    for bar, count, left, right in zip(bars, counts, edges[:-1], edges[1:]):
+        bar.set_x(left)
+        bar.set_width(right - left)
+        bar.set_height(count)
+
+
+def reset_empty_limits(ax):
+    '''Reset the view limits of an axes without finite data.
+
+    autoscale_view keeps the current limits of such axes, e.g. those of the
+    previous activity. The default unit limits make it autoscale them as in
+    a new figure.
+    '''
+    if not np.isfinite(ax.dataLim.get_points()).all():
+        ax.dataLim.ignore(True)
+        ax.viewLim.set_points(Bbox.unit().get_points())
+
+
+def set_scatter(collection, x, y, c):
+    collection.set_offsets(np.column_stack([x, y]))
+    collection.set_array(np.asarray(c, dtype=float))
+
+
+class ActivitySummaryFigure(object):
+    '''Activity summary figure that can be redrawn for other activities.
+
+    The layout and artists are built once, update only swaps their data,
+    which avoids the matplotlib setup cost when rendering many reports.
+    '''
+
+    BINS = 50
+
+    def __init__(self):
+        fig, axes = plt.subplots(4, 3, figsize=(15, 10))
+        self.fig = fig
+        self.axes = axes
+        props = dict(boxstyle='round', alpha=0.5, color='w')
+
+        def stats_text(ax):
+            return ax.text(1.1, 0.5, '', transform=ax.transAxes, fontsize=10,
+                           verticalalignment='center', bbox=props)
+
+        def empty_bars(ax, nbins):
+            return ax.bar(np.zeros(nbins), np.zeros(nbins), width=1.0,
+                          align='edge')
+
+        self.hr_scatter = axes[0,0].scatter([], [], c=[], s=80, vmin=50, vmax=200, marker='.', alpha=0.5)
+        axes[0,0].set_ylabel('Heart rate [bpm]')
+        self.hr_bars = empty_bars(axes[0,1], self.BINS)
+        axes[0,1].set_xlabel('Heart rate [bpm]')
+        self.hr_stats = stats_text(axes[0,1])
+
+        self.speed_line, = axes[1,0].plot([], [], linewidth=0.8, alpha=0.5)
+        axes[1,0].set_ylabel('Speed [km/h]')
+        self.slope_scatter = axes[1,1].scatter([], [], c=[], s=60, vmin=50, vmax=200, marker='.', alpha=1)
+        axes[1,1].set_xlabel('Slope')
+        axes[1,1].set_ylabel('Speed')
+        self.speed_stats = stats_text(axes[1,1])
+
+        self.cadence_line, = axes[2,0].plot([], [], linewidth=0.8, alpha=0.5, marker='.', linestyle='none', markersize=2)
+        axes[2,0].set_ylabel('Cadence [spm]')
+        self.cadence_bars = empty_bars(axes[2,1], self.BINS)
+        axes[2,1].set_xlabel('Cadence')
+        self.cadence_stats = stats_text(axes[2,1])
+
+        self.alt_scatter = axes[3,0].scatter([], [], c=[], s=80, vmin=50, vmax=200, marker='.', alpha=0.5)
+        axes[3,0].set_ylabel('Altitude [m]')
+        axes[3,0].set_xlabel('Minutes')
+        self.alt_bars = empty_bars(axes[3,1], 10)
+        axes[3,1].set_xlabel('Altitude')
+        self.alt_stats = stats_text(axes[3,1])
+
+        for i in range(4):
+            axes[i,2].set_axis_off()
+
+        self.date_text = axes[0,1].text(0.5, 1.2, '', transform=axes[0,1].transAxes, fontsize=12,
+                    verticalalignment='center', bbox=props, fontweight='bold', horizontalalignment='center')
+        self.summary_text = axes[2,2].text(0.5, 0.5, '', transform=axes[2,2].transAxes, fontsize=12,
+                    verticalalignment='center', bbox=props, fontweight='bold', horizontalalignment='left')
+
+    def update(self, df):
+        '''Draw the activity df and return the figure.'''
+        axes = self.axes
+        df = df.copy()
+        df['Mins']=df['SecondsElapsed']/60
+
+        # Plot decimated time series, statistics and histograms use all data
+        hr_rows = decimate.decimate_series(df, 'Mins', 'HeartRateBpm')
+        speed_rows = decimate.decimate_series(df, 'Mins', 'Speed')
+        cad_rows = decimate.decimate_series(df, 'Mins', 'Cadence')
+        alt_rows = decimate.decimate_series(df, 'Mins', 'AltitudeMeters')
+        # The slope scatter shows a distribution, not a time series
+        slope_rows = decimate.decimate_scatter(df, ['Slope', 'Speed'])
+
+        set_scatter(self.hr_scatter, hr_rows['Mins'], hr_rows['HeartRateBpm'], hr_rows['HeartRateBpm'])
+        HR=df['HeartRateBpm']
+        set_hist(self.hr_bars, HR, np.linspace(HR.min(), HR.max(), self.BINS + 1))
+        self.hr_stats.set_text(statsbox(df, 'HeartRateBpm'))
+
+        self.speed_line.set_data(speed_rows['Mins'], speed_rows['Speed'])
+        set_scatter(self.slope_scatter, slope_rows['Slope'], slope_rows['Speed'], slope_rows['HeartRateBpm'])
+        self.speed_stats.set_text(statsbox(df, 'Speed'))
+
+        self.cadence_line.set_data(cad_rows['Mins'], cad_rows['Cadence'])
+        Cad=df['Cadence']
+        Cad=np.array(Cad[Cad>0])
+        if Cad.size:
+            set_hist(self.cadence_bars, Cad, np.linspace(Cad.min(), Cad.max(), self.BINS + 1))
+        else:
+            set_hist(self.cadence_bars, Cad, self.BINS)
+        self.cadence_stats.set_text(statsbox(df, 'Cadence'))
+
+        set_scatter(self.alt_scatter, alt_rows['Mins'], alt_rows['AltitudeMeters'], alt_rows['HeartRateBpm'])
+        set_hist(self.alt_bars, df['AltitudeMeters'], 10)
+        self.alt_stats.set_text(statsbox(df, 'AltitudeMeters'))
+
+        self.date_text.set_text(df['Time'].min().strftime('%d/%m/%Y %H:%M') + '-' + df['Time'].max().strftime('%H:%M'))
+
+        Duration=df['Mins'].max()
+        Eldiff=np.diff(df['AltitudeMeters'])
+        ElGain=Eldiff[Eldiff>0]
+        ElGain=ElGain.sum()
+        ElLoss=np.abs(Eldiff[Eldiff<0])
+        ElLoss=ElLoss.sum()
+        self.summary_text.set_text('Total time: %0.0f mins.\nElevation gain: %0.0f m\nElevation loss: %0.0f m'%(Duration, ElGain, ElLoss))
+
+        # relim ignores collections, add the scatter data explicitly
+        for ax in axes[:,:2].flat:
+            ax.relim()
+        for scatter in (self.hr_scatter, self.slope_scatter, self.alt_scatter):
+            scatter.axes.update_datalim(scatter.get_offsets())
+        for ax in axes[:,:2].flat:
+            reset_empty_limits(ax)
+            ax.autoscale_view()
+        for i in range(4):
+            axes[i,0].set_xlim(0,df['Mins'].max())
+        return self.fig
+
+
+def activity_summary_figure(df):
+    return ActivitySummaryFigure().update(df)
+
+
+def main(filename):
+    basename = filename[:-4]
+    df = parse_tcx.get_activity_data(filename)
+
+    # Basic statistics as html document
+    print('Basic statistics')
+    df.describe().to_html(basename + '-statistics.html')
+
+    print('Heart rate plot')
+    with instrument.stage('figure', filename):
+        fig = activity_summary_figure(df)
+    with instrument.stage('render', filename):
+        fig.savefig(basename + '-ActivitySummary.png')
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    #Path to tcx file assumed to be passed as cmd line argument
+    main(sys.argv[1])
@@ -9,28 +9,41 @@ import matplotlib.pyplot as plt
 import datetime
 from matplotlib.backends.backend_pdf import PdfPages
 import minimalreport
-import activitymap
 import parse_tcx
+import instrument
 
 
-def main(filename):
+def main(filename, mr_report=None, maps=True):
     #Set A4 figure size
     plt.rc('figure', figsize=(11.69, 8.27), dpi=100)
 
     basename = filename[:-4]
     df = parse_tcx.get_activity_data(filename)
     with PdfPages(basename + '-ActivitySummary.pdf') as pdf:
-        print('Maps')
-        mapfig = activitymap.activity_map_figure(df)
-        plt.tight_layout()
-        pdf.savefig(mapfig)
-        plt.close(mapfig)
+        # Only pull in cartopy for activities with positions
+        if maps and df['Latitude'].notnull().any():
+            import activitymap
+            print('Maps')
+            with instrument.stage('figure', filename):
+                mapfig = activitymap.activity_map_figure(df)
+            with instrument.stage('render', filename):
+                plt.tight_layout()
+                pdf.savefig(mapfig)
+            plt.close(mapfig)
 
         print('Minimal report')
-        mr_fig = minimalreport.minimal_report_figure(df)
-        plt.tight_layout()
-        pdf.savefig(mr_fig)
-        plt.close(mr_fig)
+        # A MinimalReportFigure passed in is reused, e.g. in batch runs
+        resampled = parse_tcx.get_resampled_data(filename)
+        with instrument.stage('figure', filename):
+            if mr_report is None:
+                mr_fig = minimalreport.minimal_report_figure(df, resampled)
+            else:
+                mr_fig = mr_report.update(df, resampled)
+        with instrument.stage('render', filename):
+            mr_fig.tight_layout()
+            pdf.savefig(mr_fig)
+        if mr_report is None:
+            plt.close(mr_fig)
 
         info = pdf.infodict()
         info['CreationDate'] = datetime.datetime.today()
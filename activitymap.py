@@ -2,40 +2,68 @@
 '''
 Create map with activity position points, colored by speed.
 '''
+import io
 import sys
 import matplotlib
 matplotlib.use('agg')
-import pandas as pd
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-from cartopy.io.img_tiles import StamenTerrain, GoogleTiles, MapQuestOSM
+from cartopy.io.img_tiles import GoogleWTS
+from PIL import Image
 import parse_tcx
+import tiles
+import decimate
+import instrument
 
 
-def activity_map_figure(df):
-    #Some position shorthands
-    lon = df['Longitude']
-    lat = df['Latitude']
-    dlon = 0.1*(lon.max() - lon.min())
-    dlat = 0.1*(lat.max() - lat.min())
+class CachedTiler(GoogleWTS):
+    '''Cartopy tile source drawing the tiles of a tiles.TileReader.'''
 
-    #Set up Cartopy map tiles, using OpenStreetMap
-    tiler = MapQuestOSM()
+    def __init__(self, reader, desired_tile_form='RGB'):
+        GoogleWTS.__init__(self, desired_tile_form=desired_tile_form)
+        self.reader = reader
+
+    def get_image(self, tile):
+        try:
+            data = self.reader.read_tile(tile)
+        except IOError:
+            data = None
+        if data is None:
+            # Missing tiles are left blank
+            img = Image.new(self.desired_tile_form, (256, 256), 'white')
+        else:
+            img = Image.open(io.BytesIO(data))
+            img = img.convert(self.desired_tile_form)
+        return img, self.tileextent(tile), 'lower'
+
+
+def get_tiler(tiles_source=None, cache_dir=None):
+    '''Cartopy tile source for activity maps, see tiles.get_tile_reader.'''
+    return CachedTiler(tiles.get_tile_reader(tiles_source, cache_dir))
+
+
+def activity_map_figure(df, tiler=None, max_points=decimate.MAX_POINTS):
+    #Set up Cartopy map tiles, by default cached OpenStreetMap tiles
+    if tiler is None:
+        tiler = get_tiler()
+    extent = tiles.map_extent(df['Longitude'], df['Latitude'])
+    #Only plot a simplified track, but report means of all data
+    means = df[['Speed', 'HeartRateBpm']].mean()
+    track = decimate.decimate_track(df, max_points)
     fig = plt.figure()
 
     units = ['km/h', 'bpm']
     columns = ['Speed', 'HeartRateBpm']
     for i, (unit, col) in enumerate(zip(units, columns)):
         ax = fig.add_subplot(1, 2, i+1, projection=tiler.crs)
-        ax.set_extent((lon.min()-dlon, lon.max()+dlon,
-                       lat.min()-dlat, lat.max()+dlat))
-        ax.add_image(tiler, 15)
+        ax.set_extent(extent)
+        ax.add_image(tiler, tiles.MAP_ZOOM)
 
         #Plot activity positions on map, color by speed
-        im = ax.scatter(df['Longitude'], df['Latitude'], c=df[col],
+        im = ax.scatter(track['Longitude'], track['Latitude'], c=track[col],
                 transform=ccrs.Geodetic(), s=40, edgecolor='none',
                 cmap=plt.cm.hot_r, alpha=0.5)
-        ax.set_title('Mean = {0:.1f} [{1}]'.format(df[col].mean(), unit))
+        ax.set_title('Mean = {0:.1f} [{1}]'.format(means[col], unit))
         cbar = plt.colorbar(im, shrink=.5, drawedges=False)
         cbar.set_label('{0} [{1}]'.format(col, unit))
         cbar.solids.set_rasterized(True)
@@ -45,13 +73,17 @@ def activity_map_figure(df):
     #    df['SecondsElapsed'].max()/60))
     return fig
 
-if __name__ == '__main__':
-    pd.options.display.mpl_style = 'default'
-    filename = sys.argv[1]
+def main(filename):
     basename = filename[:-4]
     df = parse_tcx.get_activity_data(filename)
     print('Plotting maps')
-    fig = activity_map_figure(df)
-    plt.tight_layout()
-    fig.savefig(basename + '-mapspeed.png', dpi=200)
+    with instrument.stage('figure', filename):
+        fig = activity_map_figure(df)
+    with instrument.stage('render', filename):
+        plt.tight_layout()
+        fig.savefig(basename + '-mapspeed.png', dpi=200)
     plt.close(fig)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+Activity files inside Garmin bulk export archives and gzip files.
+
+Members of zip archives are addressed as 'export.zip::path/in/archive.tcx'
+sources, which the parsers, the activity cache and ingest accept wherever
+they take a file name. Members and .gz files are read as streams, nothing
+is extracted to disk.
+
+A member or .gz file gets the cache key of the plain file it holds, a hash
+of its uncompressed content. The activity cache remembers it by the CRC32
+and size of the content, which are read from the zip directory or the
+gzip trailer, so unchanged sources are recognized without reading them.
+'''
+import os
+import glob
+import gzip
+import struct
+import zipfile
+import hashlib
+import contextlib
+
+
+SEPARATOR = '::'
+
+#: Names of the activity files read from archives.
+ACTIVITY_SUFFIXES = ('.tcx', '.tcx.gz', '.fit', '.fit.gz')
+
+# Open zip archives by path. Forked worker processes must not read from the
+# file descriptors they inherit, which share their offset with the parent.
+_zips = {}
+
+
+def split(source):
+    '''(archive, member) of an archive member source, else (source, None).'''
+    if SEPARATOR in source:
+        path, member = source.split(SEPARATOR, 1)
+        return path, member
+    return source, None
+
+
+def is_member(source):
+    return SEPARATOR in source
+
+
+def member_source(path, member):
+    return path + SEPARATOR + member
+
+
+def is_activity(name):
+    return name.lower().endswith(ACTIVITY_SUFFIXES)
+
+
+def source_name(source):
+    '''File name of a source without archive path and .gz suffix, which
+    tells the parser to use.'''
+    name = split(source)[1] or source
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return name
+
+
+def is_stream(source):
+    '''True if source has to be read through open_source.'''
+    return is_member(source) or source.lower().endswith('.gz')
+
+
+def get_zip(path):
+    '''Open zip archive, kept open for the following members.'''
+    st = os.stat(path)
+    state = (os.getpid(), st.st_mtime, st.st_size)
+    if path not in _zips or _zips[path][0] != state:
+        if path in _zips and _zips[path][0][0] == state[0]:
+            _zips[path][1].close()
+        _zips[path] = (state, zipfile.ZipFile(path))
+    return _zips[path][1]
+
+
+def members(path):
+    '''Sources of the activity files in a zip archive, in archive order.'''
+    return [member_source(path, info.filename)
+            for info in get_zip(path).infolist()
+            if not info.is_dir() and is_activity(info.filename)]
+
+
+def expand(paths):
+    '''Sources of paths, with zip archives replaced by their members.'''
+    sources = []
+    for path in paths:
+        if zipfile.is_zipfile(path):
+            sources.extend(members(path))
+        else:
+            sources.append(path)
+    return sources
+
+
+def find_sources(directory):
+    '''Sources of the zip archives and gzipped activity files in directory.
+
+    Export archives name their files by activity number, not by date and
+    sport like the tcx files of a directory.
+    '''
+    paths = sorted(glob.glob(os.path.join(directory, '*.zip')))
+    gzipped = sorted(path for path in glob.glob(os.path.join(directory, '*.gz'))
+                     if is_activity(path))
+    return expand(paths) + gzipped
+
+
+@contextlib.contextmanager
+def open_source(source):
+    '''Binary stream of an activity file, decompressed if it is gzipped.'''
+    path, member = split(source)
+    name = member or path
+    if member is None:
+        f = open(path, 'rb')
+    else:
+        f = get_zip(path).open(member)
+    try:
+        if name.lower().endswith('.gz'):
+            with gzip.GzipFile(fileobj=f) as g:
+                yield g
+        else:
+            yield f
+    finally:
+        f.close()
+
+
+def content_key(source):
+    '''SHA1 of the uncompressed content of a source, the same for a file,
+    its gzipped copy and an archive member of either.'''
+    h = hashlib.sha1()
+    with open_source(source) as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def crc_key(source):
+    '''Hash of the CRC32 and size of the uncompressed content of a member or
+    .gz file, found without reading it. None for gzipped members.'''
+    path, member = split(source)
+    if member is None:
+        # The trailer of a gzip file holds the CRC32 and size of its content
+        with open(path, 'rb') as f:
+            f.seek(-8, os.SEEK_END)
+            crc, size = struct.unpack('<II', f.read(8))
+    elif member.lower().endswith('.gz'):
+        return None
+    else:
+        info = get_zip(path).getinfo(member)
+        crc, size = info.CRC, info.file_size
+    return hashlib.sha1('crc:{0:08x}:{1}'.format(
+        crc & 0xFFFFFFFF, size & 0xFFFFFFFF).encode()).hexdigest()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Render reports of many activities in parallel worker processes.
+
+Usage: python batch_report.py [-j N] [-k minimal,summary,pdf] [--no-maps]
+                              path [path ...]
+
+Paths are tcx or FIT files, or directories of them. Every worker builds the
+report figures once, and only swaps in the data of each activity it renders.
+Report files appear next to the tcx files, as with the single-file scripts.
+'''
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+import traceback
+import matplotlib
+matplotlib.use('agg')
+import parse_tcx
+import instrument
+
+
+KINDS = ['minimal', 'summary', 'pdf']
+
+# Report figures of this worker process, built on first use
+_figures = {}
+
+
+def get_figure(kind):
+    '''Reusable report figure of the given kind for this process.'''
+    if kind not in _figures:
+        if kind == 'minimal':
+            import minimalreport
+            _figures[kind] = minimalreport.MinimalReportFigure()
+        elif kind == 'summary':
+            import activity_summary
+            _figures[kind] = activity_summary.ActivitySummaryFigure()
+        else:
+            raise ValueError('Unknown report kind: {0}'.format(kind))
+    return _figures[kind]
+
+
+def render_file(filename, kinds=KINDS, maps=True):
+    '''Render the reports of one tcx file.
+
+    maps=False leaves the map page out of the pdf report, which then does
+    not need cartopy. Returns (filename, error) where error is None on
+    success.
+    '''
+    try:
+        basename = filename[:-4]
+        df = parse_tcx.get_activity_data(filename)
+        if 'minimal' in kinds or 'summary' in kinds:
+            df.describe().to_html(basename + '-statistics.html')
+        if 'minimal' in kinds:
+            resampled = parse_tcx.get_resampled_data(filename)
+            with instrument.stage('figure', filename):
+                fig = get_figure('minimal').update(df, resampled)
+            with instrument.stage('render', filename):
+                fig.savefig(basename + '-heartrate.png')
+        if 'summary' in kinds:
+            with instrument.stage('figure', filename):
+                fig = get_figure('summary').update(df)
+            with instrument.stage('render', filename):
+                fig.savefig(basename + '-ActivitySummary.png')
+        if 'pdf' in kinds:
+            # Maps need cartopy, only import it when asked for
+            import activity_summary_pdf
+            activity_summary_pdf.main(filename, get_figure('minimal'), maps)
+        return filename, None
+    except Exception:
+        return filename, traceback.format_exc()
+
+
+def _render_worker(args):
+    return render_file(*args)
+
+
+def find_tcx_files(paths):
+    '''tcx and FIT files given directly or found in the given directories.'''
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, '*.tcx')) +
+                                    glob.glob(os.path.join(path, '*.fit'))))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def render_files(filenames, kinds=KINDS, processes=None, maps=True):
+    '''Render reports of all filenames, returning the failed ones.'''
+    tasks = [(filename, kinds, maps) for filename in filenames]
+    pool = None
+    if processes == 1:
+        results = map(_render_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_render_worker, tasks)
+
+    failed = []
+    try:
+        for i, (filename, error) in enumerate(results):
+            status = 'ok' if error is None else 'FAILED'
+            print('[{0}/{1}] {2}: {3}'.format(i + 1, len(tasks), filename,
+                                             status))
+            if error is not None:
+                print(error)
+                failed.append(filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('paths', nargs='+',
+                        help='tcx files or directories of tcx files')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('-k', '--kinds', default='minimal,summary',
+                        help='comma separated reports to render, out of '
+                             '{0} (default: minimal,summary)'.format(
+                                 ','.join(KINDS)))
+    parser.add_argument('--no-maps', action='store_true',
+                        help='leave the map page out of pdf reports (no '
+                             'cartopy needed)')
+    args = parser.parse_args()
+
+    kinds = args.kinds.split(',')
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error('unknown report kind: {0}'.format(kind))
+    failed = render_files(find_tcx_files(args.paths), kinds, args.processes,
+                          not args.no_maps)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of parsing, caching, aggregation and figures on synthetic data.
+
+Usage: python benchmark.py [-o results.json] [--sizes 1800,7200,28800]
+                           [--repeat 3] [--compare baseline.json]
+
+Every benchmark runs on synthetic activities (see synthetic.py) of each
+size, and reports the best and median wall time of its repeats. Results are
+written as JSON, and --compare prints the time ratios against a previous
+results file, e.g. one from another version.
+'''
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import contextlib
+import subprocess
+import numpy as np
+import synthetic
+
+
+#: Number of trackpoints of the benchmarked activities.
+SIZES = [1800, 7200, 28800]
+
+
+def timed(func, setup=None, repeat=3):
+    '''Wall times of repeat calls of func, after setup if given.
+
+    Output printed by func is discarded.
+    '''
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name, npoints, times):
+    return dict(benchmark=name, npoints=npoints, repeat=len(times),
+                best=min(times), median=float(np.median(times)))
+
+
+def render(fig):
+    '''Draw a figure to memory and close it.'''
+    import matplotlib.pyplot as plt
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def benchmark_size(directory, npoints, repeat=3):
+    '''Run all benchmarks on activities of npoints trackpoints.'''
+    import matplotlib
+    matplotlib.use('agg')
+    import parse_tcx
+    import activity_cache
+    import fit
+    import totals
+    import minimalreport
+    import activity_summary
+
+    run = synthetic.write_tcx(
+        os.path.join(directory, 'run-{0}.tcx'.format(npoints)), 'Running',
+        npoints)
+    bike = synthetic.write_tcx(
+        os.path.join(directory, 'bike-{0}.tcx'.format(npoints)), 'Biking',
+        npoints, seed=1)
+    cache_dir = os.path.join(directory, 'cache-{0}'.format(npoints))
+
+    def clear_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = []
+
+    def bench(name, func, setup=None):
+        times = timed(func, setup, repeat)
+        results.append(result(name, npoints, times))
+        print('{0:>28} {1:>7} {2:9.4f} s'.format(name, npoints, min(times)))
+
+    bench('load_tcx_data', lambda: parse_tcx.load_tcx_data(run))
+    bench('load_tcx_data_biking', lambda: parse_tcx.load_tcx_data(bike))
+    bench('load_tcx_data_stream',
+          lambda: parse_tcx.load_tcx_data(run, stream=True))
+    run_fit = synthetic.write_fit(
+        os.path.join(directory, 'run-{0}.fit'.format(npoints)), 'Running',
+        npoints)
+    bench('load_fit_data', lambda: fit.load_fit_data(run_fit))
+    # Decoding them is checked by verify_fit.py
+    compressed_fit = synthetic.write_fit(
+        os.path.join(directory, 'run-{0}-compressed.fit'.format(npoints)),
+        'Running', npoints, interval=5, compressed=True)
+    bench('load_fit_data_compressed',
+          lambda: fit.load_fit_data(compressed_fit))
+    bench('get_activity_data_miss',
+          lambda: parse_tcx.get_activity_data(run, cache_dir), clear_cache)
+    bench('get_activity_data_hit',
+          lambda: parse_tcx.get_activity_data(run, cache_dir))
+
+    # Memory-mapped cache format, only touching the columns of the totals
+    npy_cache = activity_cache.ActivityCache(
+        os.path.join(directory, 'cache-npy-{0}'.format(npoints)),
+        version=parse_tcx.SCHEMA_VERSION, fmt='npy')
+    with contextlib.redirect_stdout(io.StringIO()):
+        npy_cache.store(run, parse_tcx.get_activity_data(run, cache_dir))
+    bench('cache_hit_npy',
+          lambda: npy_cache.load(run)[['HeartRateBpm', 'Speed']].sum())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = parse_tcx.get_activity_data(run, cache_dir)
+
+    def add_totals():
+        summary = totals.Totals(6, 20, scatter_size=1000)
+        summary.add(df)
+        return summary
+    bench('totals_add', add_totals)
+
+    summary = add_totals()
+    panels = [('HeartRateBpm', 'Heart rate [bpm]', [50, 200]),
+              ('Cadence', 'Cadence', [60, 200]),
+              ('Speed', 'Speed', None)]
+    bench('totals_figure',
+          lambda: render(totals.totals_figure(summary, 'bench', panels)))
+    bench('minimal_report_figure',
+          lambda: render(minimalreport.minimal_report_figure(df)))
+    bench('activity_summary_figure',
+          lambda: render(activity_summary.activity_summary_figure(df)))
+
+    try:
+        import activitymap
+    except ImportError:
+        print('{0:>28} {1:>7}   skipped (no cartopy)'.format(
+            'activity_map_figure', npoints))
+    else:
+        import tiles
+        # Blank tiles, so the map benchmark does not depend on the network
+        tile_dir = os.path.join(directory, 'tiles')
+        tiler = activitymap.CachedTiler(
+            tiles.TileReader(tiles.DirectorySource(tile_dir)))
+        bench('activity_map_figure',
+              lambda: render(activitymap.activity_map_figure(df, tiler)))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=SIZES, repeat=3, directory=None):
+    '''Run the benchmarks for all sizes and return the results document.'''
+    import pandas as pd
+    tmp = directory is None
+    if tmp:
+        directory = tempfile.mkdtemp(prefix='pygarmin-bench-')
+    try:
+        results = []
+        for npoints in sizes:
+            results.extend(benchmark_size(directory, npoints, repeat))
+    finally:
+        if tmp:
+            shutil.rmtree(directory, ignore_errors=True)
+    meta = dict(date=datetime.datetime.now().isoformat(),
+                revision=git_revision(),
+                python=platform.python_version(),
+                numpy=np.__version__, pandas=pd.__version__,
+                machine=platform.machine(), platform=platform.platform())
+    return dict(meta=meta, results=results)
+
+
+def compare(results, baseline):
+    '''Print the best time ratio of results over baseline per benchmark.'''
+    base = dict(((r['benchmark'], r['npoints']), r['best'])
+                for r in baseline['results'])
+    print('{0:>28} {1:>7} {2:>10} {3:>10} {4:>7}'.format(
+        'benchmark', 'npoints', 'baseline', 'current', 'ratio'))
+    for r in results['results']:
+        key = (r['benchmark'], r['npoints'])
+        if key in base:
+            print('{0:>28} {1:>7} {2:10.4f} {3:10.4f} {4:7.2f}'.format(
+                key[0], key[1], base[key], r['best'], r['best']/base[key]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='results file (default: benchmark.json)')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated numbers of trackpoints')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark (default: 3)')
+    parser.add_argument('--compare', default=None,
+                        help='previous results file to compare against')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run_benchmarks(sizes, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to ' + args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,145 +6,73 @@ import sys
 import os
 import matplotlib
 matplotlib.use('agg')
-import pandas as pd
 import matplotlib.pyplot as plt
 import parse_tcx
-import numpy as np
-import datetime
-from ipdb import set_trace as debug
+import archive
+import fingerprint
+import ingest
+import activity_store
+import totals
+import instrument
 import glob
 
-def statsbox(var,ax):
-    #VAR=df[var]
-    VAR=var[var>0]
-    #VAR=np.ma.masked_equal(VAR,0)
-    VARmean = VAR.mean()
-    VARmin = VAR.min()
-    VARmax = VAR.max()
-    textstr = 'Min=%.2f\nMean=%.2f\nMax=%.2f'%(VARmin, VARmean, VARmax)
-    props = dict(boxstyle='round', alpha=0.5, color='w')
-    axes[ax[0],ax[1]].text(1.1, 0.5, textstr, transform=axes[ax[0],ax[1]].transAxes, fontsize=10, verticalalignment='center', bbox=props)
-
-pd.options.display.mpl_style = 'default'
-
-# Path to tcx directory assumed to be passed as cmd line argument
-TCXDirectory = sys.argv[1]
-outpath = sys.argv[2]
-datefilt = sys.argv[3]
-
-# list tcx files
-FileNames=glob.glob(os.path.join(TCXDirectory,datefilt + '*Cycling_Cycling*.tcx'))
-
-print(len(FileNames),' Files found')
-
-all_HR=list([])
-all_slope=list([])
-all_cadence=list([])
-all_speed=list([])
-Duration=0
-ElGain=0
-ElLoss=0
-c=0
-for F in range(len(FileNames)):
-    filename = FileNames[F]
-
-    # Load TCX file activity data.
-    # Then store it as a HDF5 file.
-    # If HDF5 file already exists, load data from there.
-    basenameIN = os.path.basename(filename)
-
-    print(F)
-    print(filename)
-
-    basenameOUT = os.path.join(outpath, basenameIN[:-4])
-
-    filename_df = basenameOUT + '.h5'
-    if os.path.exists(filename_df):
-        print('Loading data from HDF5 file')
-        df = pd.read_hdf(filename_df, 'ActivityData')
-    else:
-        df = parse_tcx.load_tcx_data(filename)
-
-        print('Storing data to HDF5 file: ', filename_df)
-        df.to_hdf(filename_df, 'ActivityData')
-
-    HR_TF='HeartRateBpm' in df.columns
-    if HR_TF==False:
-        continue
-
-    HR=list(df['HeartRateBpm'])
-
-    df['Mins']=df['SecondsElapsed']/60
-    df['Hrs']=df['Mins']/60
-    Duration+=df['Hrs'].max()
-
-    Eldiff=np.diff(df['AltitudeMeters'])
-    ElGain_=Eldiff[Eldiff>0]
-    ElGain+=ElGain_.sum()
-    ElLoss_=np.abs(Eldiff[Eldiff<0])
-    ElLoss+=ElLoss_.sum()
-
-    all_HR=np.append(HR,all_HR)
-
-    SLOPE=list(df['Slope'])
-    all_slope=np.append(SLOPE,all_slope)
-
-    CADENCE=list(df['Cadence'])
-    all_cadence=np.append(CADENCE,all_cadence)
-
-    SPEED=list(df['Speed'])
-    all_speed=np.append(SPEED,all_speed)
-
-    c+=1
+MIN_SPEED=4
+MAX_SPEED=70
 
-print('Data extracted.')
+PANELS = [('HeartRateBpm', 'Heart rate [bpm]', [50, 200]),
+          ('Speed', 'Speed', None)]
 
-all_slope=all_slope[all_HR>0]
-all_speed=all_speed[all_HR>0]
-all_cadence=all_cadence[all_HR>0]
-all_HR=all_HR[all_HR>0]
 
-MIN_SPEED=4
-MAX_SPEED=70
+def main(TCXDirectory, outpath, datefilt, processes=None, scatter_size=0,
+         compact=False):
+    # list tcx files
+    FileNames=glob.glob(os.path.join(TCXDirectory,datefilt + '*Cycling_Cycling*.tcx'))
 
-all_slope=all_slope[all_speed>MIN_SPEED]
-all_cadence=all_cadence[all_speed>MIN_SPEED]
-all_HR=all_HR[all_speed>MIN_SPEED]
-all_speed=all_speed[all_speed>MIN_SPEED]
+    # Activities of export archives are matched by sport and start time
+    # once they are in the store
+    Members = archive.find_sources(TCXDirectory)
 
-all_slope=all_slope[all_speed<MAX_SPEED]
-all_cadence=all_cadence[all_speed<MAX_SPEED]
-all_HR=all_HR[all_speed<MAX_SPEED]
-all_speed=all_speed[all_speed<MAX_SPEED]
+    print(len(FileNames),' Files found')
+    if Members:
+        print(len(Members),' archived activities found')
 
-plt.close("all")
-fig, axes = plt.subplots(3, 2, figsize=(10, 10))
+    # New files are added to the consolidated store, which then only reads
+    # the partitions and columns of the matched activities
+    store = activity_store.ActivityStore(os.path.join(outpath, 'activities.h5'))
+    ids = ingest.update_store(store, FileNames + Members, outpath, processes,
+                              compact=compact)
+    ids = ids[:len(FileNames)] + totals.period_ids(
+        store, ids[len(FileNames):], datefilt)
+    # The same workout recorded twice is only counted once
+    ids = fingerprint.unique_ids(store, ids)
 
-axes[0,0].hist(all_HR,bins=np.linspace(50,200,70))
-axes[0,0].set_xlabel('Heart rate [bpm]')
-axes[0,0].set_xlim([50,200])
-statsbox(all_HR,[0,0])
+    # Totals are merged from cached per-activity summaries
+    summary = totals.archive_totals(store, parse_tcx.get_cache(outpath), ids,
+                                    'Biking', MIN_SPEED, MAX_SPEED,
+                                    scatter_size)
 
-axes[1,0].hist(all_speed,bins=np.linspace(MIN_SPEED,MAX_SPEED,50))
-axes[1,0].set_xlabel('Speed')
-statsbox(all_speed,[1,0])
+    print('Data extracted.')
+    print(summary.count)
 
-axes[2,0].scatter(all_slope,all_speed,c=all_HR,s=100,vmin=50,vmax=200,marker='.',alpha=0.1)
-axes[2,0].set_xlabel('Slope')
-axes[2,0].set_ylabel('Speed')
-axes[2,0].set_ylim([MIN_SPEED,MAX_SPEED])
-axes[2,0].set_xlim([-45,45])
+    plt.close("all")
+    with instrument.stage('figure'):
+        fig = totals.totals_figure(summary, datefilt, PANELS)
 
-for i in range(3):
-    axes[i,1].set_axis_off()
+    OutputFileName=os.path.join(outpath,'Bike-Summary-' + datefilt + '.png')
 
-print(c)
+    with instrument.stage('render'):
+        plt.savefig(OutputFileName)
+    plt.close()
 
-textstr = 'Summary for: ' + datefilt + '\n\n%0.0f activities totalling %0.2f hrs.\nElevation gain: %0.0f m\nElevation loss: %0.0f m'%(c,Duration, ElGain, ElLoss)
-props = dict(boxstyle='round', alpha=0.5, color='w')
-axes[0,1].text(0.3, 0.5, textstr, transform=axes[0,1].transAxes, fontsize=12,verticalalignment='center', bbox=props, fontweight='bold',horizontalalignment='left')
 
-OutputFileName=os.path.join(outpath,'Bike-Summary-' + datefilt + '.png')
+if __name__ == '__main__':
+    # Path to tcx directory assumed to be passed as cmd line argument
+    TCXDirectory = sys.argv[1]
+    outpath = sys.argv[2]
+    datefilt = sys.argv[3]
+    # Optional number of worker processes, default one per CPU
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    # Optional number of points in the slope/speed scatter plot
+    scatter_size = int(sys.argv[5]) if len(sys.argv) > 5 else 0
 
-plt.savefig(OutputFileName)
-plt.close()
+    main(TCXDirectory, outpath, datefilt, processes, scatter_size)
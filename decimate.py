@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+Shape preserving decimation of tracks and time series before plotting.
+
+Tracks (latitude/longitude) are simplified with Ramer-Douglas-Peucker,
+keeping the points that deviate most from the simplified line first. Time
+series are reduced with largest-triangle-three-buckets (LTTB). Scatter plots
+of one column against another get an evenly spaced subsample, which keeps
+their distribution. All keep a target number of points, so figures stay
+light for long activities.
+'''
+import heapq
+import numpy as np
+
+
+#: Default number of points kept for plotting.
+MAX_POINTS = 2000
+
+
+def _segment_distances(x, y, i, j):
+    # Distance of the points strictly between i and j to the line i-j
+    px, py = x[i + 1:j], y[i + 1:j]
+    dx, dy = x[j] - x[i], y[j] - y[i]
+    norm = np.hypot(dx, dy)
+    if norm == 0:
+        return np.hypot(px - x[i], py - y[i])
+    return np.abs(dy*(px - x[i]) - dx*(py - y[i]))/norm
+
+
+def rdp(x, y, max_points=None, epsilon=0.0):
+    '''Indices of the points kept by Ramer-Douglas-Peucker simplification.
+
+    Points are added in order of their distance to the simplified line,
+    until max_points are kept or no point is further away than epsilon.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n <= 2 or (max_points is not None and max_points >= n):
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    heap = []
+
+    def split(i, j):
+        if j - i >= 2:
+            d = _segment_distances(x, y, i, j)
+            k = np.argmax(d)
+            heapq.heappush(heap, (-d[k], i + 1 + k, i, j))
+
+    split(0, n - 1)
+    count = 2
+    while heap and (max_points is None or count < max_points):
+        dist, k, i, j = heapq.heappop(heap)
+        if -dist <= epsilon:
+            break
+        keep[k] = True
+        count += 1
+        split(i, k)
+        split(k, j)
+    return np.flatnonzero(keep)
+
+
+def lttb(x, y, max_points):
+    '''Indices of the points kept by largest-triangle-three-buckets.'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    # First and last points are always kept, the rest is split in buckets
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    index = np.empty(max_points, dtype=int)
+    index[0] = 0
+    index[-1] = n - 1
+    a = 0
+    for b in range(max_points - 2):
+        start, end = edges[b], edges[b + 1]
+        if b + 2 < len(edges):
+            avg_x = x[end:edges[b + 2]].mean()
+            avg_y = y[end:edges[b + 2]].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # Keep the point spanning the largest triangle with the previously
+        # kept point and the average of the next bucket
+        area = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) -
+                      (x[a] - x[start:end])*(avg_y - y[a]))
+        a = start + np.argmax(area)
+        index[b + 1] = a
+    return index
+
+
+def decimate_track(df, max_points=MAX_POINTS):
+    '''Rows of df along a simplified Latitude/Longitude track.'''
+    valid = np.flatnonzero(np.isfinite(df['Latitude'].values) &
+                           np.isfinite(df['Longitude'].values))
+    lat = df['Latitude'].values[valid]
+    # Scale longitude so distances are about isotropic
+    lon = df['Longitude'].values[valid]*np.cos(np.radians(np.mean(lat)))
+    return df.iloc[valid[rdp(lon, lat, max_points)]]
+
+
+def decimate_series(df, x, y, max_points=MAX_POINTS):
+    '''Rows of df keeping the visual shape of column y against x.'''
+    valid = np.flatnonzero(np.isfinite(df[x].values) &
+                           np.isfinite(df[y].values))
+    index = lttb(df[x].values[valid], df[y].values[valid], max_points)
+    return df.iloc[valid[index]]
+
+
+def decimate_scatter(df, columns, max_points=MAX_POINTS):
+    '''Evenly spaced rows of df with finite values in all columns.
+
+    Unlike decimate_series the rows are not chosen by their values, so they
+    are an unbiased sample of the joint distribution of the columns.
+    '''
+    valid = np.ones(len(df), dtype=bool)
+    for column in columns:
+        valid &= np.isfinite(df[column].values)
+    valid = np.flatnonzero(valid)
+    if len(valid) > max_points:
+        valid = valid[np.linspace(0, len(valid) - 1, max_points).astype(int)]
+    return df.iloc[valid]
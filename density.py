@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+Binned kernel density estimates of heart rate, speed and cadence.
+
+Samples are spread over a fixed grid by linear binning, and the density is
+the binned counts convolved with a Gaussian kernel through the FFT. The cost
+depends on the grid size, not on the number of samples, and the counts of
+many activities can be merged before smoothing, for archive-wide densities.
+'''
+import numpy as np
+
+
+#: Default (low, high, number of grid points) per column.
+GRIDS = {'HeartRateBpm': (30, 230, 401),
+         'Speed': (0, 80, 401),
+         'Cadence': (0, 250, 501)}
+
+
+class BinnedDensity(object):
+    '''Linearly binned sample counts on a regular grid.'''
+
+    def __init__(self, low, high, npoints):
+        self.low = float(low)
+        self.high = float(high)
+        self.counts = np.zeros(int(npoints))
+
+    @classmethod
+    def for_column(cls, column):
+        return cls(*GRIDS[column])
+
+    @property
+    def grid(self):
+        return np.linspace(self.low, self.high, len(self.counts))
+
+    @property
+    def step(self):
+        return (self.high - self.low)/(len(self.counts) - 1)
+
+    @property
+    def n(self):
+        return self.counts.sum()
+
+    def add(self, values, weights=None):
+        '''Bin values, those outside the grid or missing are ignored.
+
+        Each value is split between its two neighboring grid points, in
+        proportion to its distance from them.
+        '''
+        values = np.asarray(values, dtype=float)
+        if weights is None:
+            weights = np.ones(values.shape)
+        weights = np.asarray(weights, dtype=float)
+        inside = (values >= self.low) & (values <= self.high)
+        position = (values[inside] - self.low)/self.step
+        weights = weights[inside]
+        npoints = len(self.counts)
+        index = np.minimum(np.floor(position).astype(np.int64), npoints - 2)
+        frac = position - index
+        self.counts += np.bincount(index, weights*(1 - frac),
+                                   minlength=npoints)
+        self.counts += np.bincount(index + 1, weights*frac,
+                                   minlength=npoints)
+
+    def merge(self, other):
+        '''Add the counts of another density on the same grid.'''
+        self.counts += other.counts
+
+    def mean_std(self):
+        grid = self.grid
+        n = self.n
+        mean = (self.counts*grid).sum()/n
+        return mean, np.sqrt((self.counts*(grid - mean)**2).sum()/n)
+
+    def bandwidth(self):
+        '''Scott's rule bandwidth of the binned samples, as in scipy.'''
+        if self.n <= 1:
+            return self.step
+        std = self.mean_std()[1]
+        return max(std*self.n**(-1/5.), self.step)
+
+    def density(self, bandwidth=None):
+        '''Gaussian kernel density on the grid, integrating to 1.
+
+        Returns zeros if there are no samples.
+        '''
+        n = self.n
+        if n == 0:
+            return np.zeros(len(self.counts))
+        if bandwidth is None:
+            bandwidth = self.bandwidth()
+        npoints = len(self.counts)
+        # Kernel out to 4 bandwidths, no wider than the grid
+        m = min(int(np.ceil(4*bandwidth/self.step)), npoints - 1)
+        kernel = np.exp(-0.5*(np.arange(-m, m + 1)*self.step/bandwidth)**2)
+        kernel /= kernel.sum()
+        # Zero-padded, so the convolution does not wrap around
+        nfft = 1 << int(np.ceil(np.log2(npoints + 2*m)))
+        smoothed = np.fft.irfft(np.fft.rfft(self.counts, nfft) *
+                                np.fft.rfft(kernel, nfft), nfft)
+        return np.maximum(smoothed[m:m + npoints], 0)/(n*self.step)
+
+    def to_dict(self):
+        return {'low': self.low, 'high': self.high,
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        density = cls(d['low'], d['high'], len(d['counts']))
+        density.counts[:] = d['counts']
+        return density
+
+
+def column_density(values, column, bandwidth=None):
+    '''Grid and density of the values of a column, see GRIDS.'''
+    binned = BinnedDensity.for_column(column)
+    binned.add(values)
+    return binned.grid, binned.density(bandwidth)
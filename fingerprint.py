@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+'''
+Fingerprints of activities, to find the same workout recorded twice.
+
+A fingerprint is the sport, start and end time of an activity, and its
+position and heart rate at NSAMPLES evenly spaced times. Fingerprints are
+indexed by the hours their activity spans, so a new activity is only
+compared with the few activities that ran at the same time.
+
+An activity that overlaps an indexed one of the same sport for most of the
+duration of both, along the same track and with the same heart rate, is
+marked as a duplicate of it, e.g. a watch and a bike computer recording the same
+ride, or a re-export of a file. Duplicates are left out of the totals, see
+unique_ids. Smaller overlaps are only flagged.
+
+Usage: python fingerprint.py <activities.h5>
+'''
+import os
+import sys
+import numpy as np
+import pandas as pd
+import activity_cache
+import spatial
+
+
+#: Number of position and heart rate samples of a fingerprint.
+NSAMPLES = 16
+
+#: Seconds per bucket of the index.
+BUCKET = 3600
+
+#: Part of the longer of two activities that must overlap the other one for
+#: them to be duplicates.
+DUPLICATE_OVERLAP = 0.8
+
+#: Median distance in meters between the tracks of duplicates.
+TRACK_TOLERANCE = 200.0
+
+#: Median difference in bpm between the heart rates of duplicates.
+HR_TOLERANCE = 10.0
+
+NAME = 'Fingerprints'
+
+COLUMNS = (['ActivityId', 'Sport', 'Start', 'End', 'DuplicateOf',
+            'Overlaps'] +
+           ['Lat{0}'.format(i) for i in range(NSAMPLES)] +
+           ['Lon{0}'.format(i) for i in range(NSAMPLES)] +
+           ['Hr{0}'.format(i) for i in range(NSAMPLES)])
+
+
+def seconds(times):
+    '''Unix time in seconds of a Time column.'''
+    values = pd.to_datetime(times, utc=True).values
+    return values.astype('datetime64[ms]').astype(np.int64)/1000.0
+
+
+def sample(t, values, at):
+    '''Values interpolated at times at, NaN if none is valid.'''
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    if not valid.any():
+        return np.full(len(at), np.nan)
+    return np.interp(at, t[valid], values[valid])
+
+
+def fingerprint(activity_id, sport, df):
+    '''Fingerprint row of an activity frame with a Time column.'''
+    t = seconds(df['Time'])
+    start, end = t[0], t[-1]
+    at = np.linspace(start, end, NSAMPLES)
+    row = {'ActivityId': activity_id, 'Sport': sport, 'Start': start,
+           'End': end, 'DuplicateOf': '', 'Overlaps': ''}
+    for prefix, column in (('Lat', 'Latitude'), ('Lon', 'Longitude'),
+                           ('Hr', 'HeartRateBpm')):
+        if column in df.columns:
+            values = sample(t, df[column].values, at)
+            if column == 'HeartRateBpm':
+                # Missing heart rate of compact frames, see parse_tcx
+                values[values < 0] = np.nan
+        else:
+            values = np.full(NSAMPLES, np.nan)
+        for i, value in enumerate(values):
+            row['{0}{1}'.format(prefix, i)] = value
+    return row
+
+
+def _signals(row, at):
+    # Positions and heart rate of a fingerprint row at times at
+    t = np.linspace(row['Start'], row['End'], NSAMPLES)
+    return [np.interp(at, t, np.asarray([row['{0}{1}'.format(prefix, i)]
+                                         for i in range(NSAMPLES)],
+                                        dtype=float))
+            for prefix in ('Lat', 'Lon', 'Hr')]
+
+
+def similar(a, b):
+    '''True if two overlapping fingerprints follow the same track and heart
+    rate during their overlap. Signals missing from either are not compared.
+    '''
+    at = np.linspace(max(a['Start'], b['Start']), min(a['End'], b['End']),
+                     NSAMPLES)
+    lat_a, lon_a, hr_a = _signals(a, at)
+    lat_b, lon_b, hr_b = _signals(b, at)
+    distance = spatial.haversine(lat_a, lon_a, lat_b, lon_b)
+    distance = distance[np.isfinite(distance)]
+    if distance.size and np.median(distance) > TRACK_TOLERANCE:
+        return False
+    hr = np.abs(hr_a - hr_b)
+    hr = hr[np.isfinite(hr)]
+    if hr.size and np.median(hr) > HR_TOLERANCE:
+        return False
+    return True
+
+
+def overlap(a, b):
+    '''Seconds during which two fingerprints overlap.'''
+    return max(0.0, min(a['End'], b['End']) - max(a['Start'], b['Start']))
+
+
+class FingerprintIndex(object):
+    '''Fingerprints of activities, indexed by the hours they span.'''
+
+    def __init__(self, table=None):
+        self._rows = []
+        self._ids = {}
+        self._buckets = {}
+        if table is not None:
+            for row in table.to_dict('records'):
+                self._insert(row)
+
+    def _insert(self, row):
+        position = len(self._rows)
+        self._rows.append(row)
+        self._ids[row['ActivityId']] = position
+        for bucket in range(int(row['Start']//BUCKET),
+                            int(row['End']//BUCKET) + 1):
+            self._buckets.setdefault(bucket, []).append(position)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def activity_ids(self):
+        return set(self._ids)
+
+    def candidates(self, row):
+        '''Indexed fingerprints sharing a bucket with row.'''
+        positions = set()
+        for bucket in range(int(row['Start']//BUCKET),
+                            int(row['End']//BUCKET) + 1):
+            positions.update(self._buckets.get(bucket, ()))
+        return [self._rows[p] for p in sorted(positions)]
+
+    def add(self, activity_id, sport, df):
+        '''Index an activity and classify it against the indexed ones.
+
+        Returns its fingerprint row, with DuplicateOf set to the activity
+        it duplicates, or Overlaps to one it only overlaps.
+        '''
+        if activity_id in self._ids:
+            return self._rows[self._ids[activity_id]]
+        row = fingerprint(activity_id, sport, df)
+        for other in self.candidates(row):
+            common = overlap(row, other)
+            if common <= 0:
+                continue
+            # Relative to the longer activity, so the classification of a
+            # pair does not depend on the order they were added in
+            duration = max(row['End'] - row['Start'],
+                           other['End'] - other['Start'], 1.0)
+            if (other['Sport'] == sport and
+                    common >= DUPLICATE_OVERLAP*duration and
+                    similar(row, other)):
+                # Always point to the activity that is kept
+                row['DuplicateOf'] = (other['DuplicateOf'] or
+                                      other['ActivityId'])
+                row['Overlaps'] = ''
+                break
+            if not row['Overlaps']:
+                row['Overlaps'] = other['ActivityId']
+        self._insert(row)
+        return row
+
+    def update(self, store):
+        '''Index the activities of store that are not indexed yet.
+
+        Activities of a sport are read in the order they were stored, so
+        the first stored of a set of duplicates is the one kept. Returns the
+        number of activities added.
+        '''
+        index = store.activities()
+        missing = set(index['ActivityId']) - self.activity_ids()
+        if not missing:
+            return 0
+        sports = dict(zip(index['ActivityId'], index['Sport']))
+        n = 0
+        for activity_id, df in store.iter_activities(
+                ids=missing, columns=['Time', 'Latitude', 'Longitude',
+                                      'HeartRateBpm']):
+            self.add(activity_id, sports[activity_id], df)
+            n += 1
+        return n
+
+    def table(self):
+        return pd.DataFrame(self._rows, columns=COLUMNS)
+
+    def duplicates(self):
+        '''Fingerprints of the activities that duplicate another one.'''
+        table = self.table()
+        return table[table['DuplicateOf'] != '']
+
+    def unique_ids(self, ids, superseded=()):
+        '''ids without the duplicates of other activities, and without the
+        superseded ones.
+
+        Of a set of duplicates in ids the first indexed one that is not
+        superseded is kept, e.g. the new version of an edited file that
+        duplicates its old version. Duplicates of activities left out of
+        ids are kept in their place.
+        '''
+        superseded = set(superseded)
+        indexed = sorted((self._ids[activity_id], activity_id)
+                         for activity_id in set(ids)
+                         if activity_id in self._ids and
+                         activity_id not in superseded)
+        kept = {}
+        for position, activity_id in indexed:
+            row = self._rows[position]
+            kept.setdefault(row['DuplicateOf'] or activity_id, activity_id)
+        kept = set(kept.values())
+        return [activity_id for activity_id in ids
+                if activity_id not in superseded and
+                (activity_id not in self._ids or activity_id in kept)]
+
+    @classmethod
+    def load(cls, path):
+        '''Saved index at path, or an empty index if there is none.'''
+        if not os.path.exists(path):
+            return cls()
+        return cls(pd.read_hdf(path, NAME))
+
+    def save(self, path):
+        table = self.table()
+        activity_cache.atomic_write(
+            path, lambda tmp: table.to_hdf(tmp, key=NAME, mode='w'))
+
+
+def index_path(store):
+    return os.path.splitext(store.path)[0] + '-fingerprints.h5'
+
+
+def get_index(store, path=None):
+    '''Fingerprint index of store, updated and saved if activities were
+    added.'''
+    if path is None:
+        path = index_path(store)
+    index = FingerprintIndex.load(path)
+    if index.update(store):
+        index.save(path)
+    return index
+
+
+def unique_ids(store, ids):
+    '''Activity ids of store without duplicates and superseded activities,
+    see ActivityStore.superseded_ids. None ids are kept.'''
+    return get_index(store).unique_ids(ids, store.superseded_ids())
+
+
+if __name__ == '__main__':
+    import activity_store
+    index = get_index(activity_store.ActivityStore(sys.argv[1]))
+    table = index.table()
+    print('{0} activities, {1} duplicates, {2} overlaps'.format(
+        len(table), (table['DuplicateOf'] != '').sum(),
+        (table['Overlaps'] != '').sum()))
+    flagged = table[(table['DuplicateOf'] != '') | (table['Overlaps'] != '')]
+    print(flagged[['ActivityId', 'Sport', 'DuplicateOf',
+                   'Overlaps']].to_string())
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+'''
+Decoder for Garmin FIT activity files. Returns the DataFrame of parse_tcx.
+
+FIT files are a sequence of definition and data messages. A single pass
+over the message headers finds where the record (trackpoint) messages are.
+The fields of all records sharing a definition are then decoded at once,
+by viewing their bytes as a NumPy structured array. Only the record, sport
+and session messages are decoded.
+'''
+import sys
+import numpy as np
+import pandas as pd
+import parse_tcx
+import instrument
+
+
+#: Seconds between the Unix epoch and the FIT epoch, 1989-12-31 00:00 UTC.
+FIT_EPOCH = 631065600
+
+#: Global message numbers.
+SPORT = 12
+SESSION = 18
+RECORD = 20
+EVENT = 21
+
+#: Sport enum values of FIT sport and session messages.
+SPORTS = {1: 'Running', 2: 'Biking'}
+
+#: NumPy types of the FIT base types, by base type number without the
+#: endian flag bit.
+BASE_TYPES = {0x00: 'u1', 0x01: 'i1', 0x02: 'u1', 0x03: 'i2', 0x04: 'u2',
+              0x05: 'i4', 0x06: 'u4', 0x07: 'S1', 0x08: 'f4', 0x09: 'f8',
+              0x0A: 'u1', 0x0B: 'u2', 0x0C: 'u4', 0x0D: 'u1', 0x0E: 'i8',
+              0x0F: 'u8', 0x10: 'u8'}
+
+#: Field number of the timestamp of all messages.
+TIMESTAMP = 253
+
+#: Invalid values of the integer types of the record fields.
+INVALID = {'u1': 0xFF, 'u2': 0xFFFF, 'u4': 0xFFFFFFFF,
+           'i1': 0x7F, 'i2': 0x7FFF, 'i4': 0x7FFFFFFF}
+
+#: Record fields read: field number -> (name, scale, offset).
+RECORD_FIELDS = {TIMESTAMP: ('timestamp', 1, 0),
+                 0: ('position_lat', 2**31/180.0, 0),
+                 1: ('position_long', 2**31/180.0, 0),
+                 2: ('altitude', 5, 500),
+                 3: ('heart_rate', 1, 0),
+                 4: ('cadence', 1, 0),
+                 5: ('distance', 100, 0),
+                 78: ('enhanced_altitude', 5, 500)}
+
+#: Columns of parse_tcx filled from record fields, preferred field first.
+COLUMN_FIELDS = {'DistanceMeters': ['distance'],
+                 'AltitudeMeters': ['enhanced_altitude', 'altitude'],
+                 'HeartRateBpm': ['heart_rate'],
+                 'Cadence': ['cadence'],
+                 'Latitude': ['position_lat'],
+                 'Longitude': ['position_long']}
+
+
+class FitError(Exception):
+    pass
+
+
+class Definition(object):
+    '''Layout of the data messages of a local message type.'''
+
+    def __init__(self, global_number, big_endian, fields, size):
+        self.global_number = global_number
+        self.big_endian = big_endian
+        # (field number, offset in message, size, base type)
+        self.fields = fields
+        self.size = size
+        # Offset of the timestamp field, None if there is none
+        self.timestamp_offset = None
+        for number, offset, size, base_type in fields:
+            if number == TIMESTAMP and size == 4:
+                self.timestamp_offset = offset
+
+    def dtype(self, wanted):
+        '''Structured dtype of the wanted {field number: name} fields.
+
+        Fields that are not present, or are arrays, are left out.
+        '''
+        endian = '>' if self.big_endian else '<'
+        names, formats, offsets = [], [], []
+        for number, offset, size, base_type in self.fields:
+            if number not in wanted:
+                continue
+            fmt = BASE_TYPES.get(base_type & 0x1F)
+            if fmt is None or np.dtype(fmt).itemsize != size:
+                continue
+            names.append(wanted[number])
+            formats.append(endian + fmt)
+            offsets.append(offset)
+        return np.dtype({'names': names, 'formats': formats,
+                         'offsets': offsets, 'itemsize': self.size})
+
+
+def read_header(data):
+    '''Header size and end of the data messages of a FIT file.'''
+    if len(data) < 12 or data[8:12] != b'.FIT':
+        raise FitError('Not a FIT file')
+    header_size = data[0]
+    data_size = int.from_bytes(data[4:8], 'little')
+    end = header_size + data_size
+    if end > len(data):
+        raise FitError('Truncated FIT file')
+    return header_size, end
+
+
+def scan_messages(data):
+    '''Find the data messages of a FIT file.
+
+    Returns {definition: (message offsets, compressed timestamps)} where
+    the timestamp is -1 for messages with a normal header. Offsets point
+    past the record header byte, and keep the file order per definition.
+
+    A compressed timestamp header holds the 5 low bits of the timestamp,
+    relative to the last full or compressed timestamp of any message. Full
+    timestamps are only decoded when a compressed header follows them.
+    '''
+    position, end = read_header(data)
+    local = {}
+    messages = {}
+    last = 0
+    # Offset and endianness of the last full timestamp not decoded yet
+    reference = None
+    while position < end:
+        header = data[position]
+        position += 1
+        if header & 0x80:
+            # Compressed timestamp header, always a data message
+            definition = local[(header >> 5) & 0x03]
+            if reference is not None:
+                offset, big_endian = reference
+                value = int.from_bytes(data[offset:offset + 4],
+                                       'big' if big_endian else 'little')
+                if value != INVALID['u4']:
+                    last = value
+                reference = None
+            last += ((header & 0x1F) - last) & 0x1F
+            timestamp = last
+        elif header & 0x40:
+            # Definition message
+            big_endian = data[position + 1] == 1
+            global_number = int.from_bytes(
+                data[position + 2:position + 4],
+                'big' if big_endian else 'little')
+            nfields = data[position + 4]
+            position += 5
+            fields = []
+            size = 0
+            for i in range(nfields):
+                number, field_size, base_type = data[position:position + 3]
+                fields.append((number, size, field_size, base_type))
+                size += field_size
+                position += 3
+            if header & 0x20:
+                # Developer fields are skipped, only their size matters
+                ndev = data[position]
+                position += 1
+                for i in range(ndev):
+                    size += data[position + 1]
+                    position += 3
+            definition = Definition(global_number, big_endian, fields, size)
+            local[header & 0x0F] = definition
+            messages.setdefault(definition, ([], []))
+            continue
+        else:
+            definition = local[header & 0x0F]
+            timestamp = -1
+            if definition.timestamp_offset is not None:
+                reference = (position + definition.timestamp_offset,
+                             definition.big_endian)
+        offsets, timestamps = messages[definition]
+        offsets.append(position)
+        timestamps.append(timestamp)
+        position += definition.size
+    if position != end:
+        raise FitError('Truncated FIT message')
+    return messages
+
+
+def decode(data, definition, offsets, wanted):
+    '''Wanted fields of the messages at offsets, as a structured array.'''
+    buf = np.frombuffer(data, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    rows = buf[offsets[:, None] + np.arange(definition.size)]
+    return rows.view(definition.dtype(wanted)).ravel()
+
+
+def field_values(records, name, scale=1, offset=0):
+    '''Scaled float values of a field, NaN where it is invalid.'''
+    values = records[name]
+    invalid = INVALID.get(values.dtype.str[1:])
+    out = values.astype(np.float64)
+    if invalid is not None:
+        out[values == invalid] = np.nan
+    return out/scale - offset
+
+
+def read_sport(data, messages=None):
+    '''Sport name of a FIT activity, from its sport or session message.'''
+    if messages is None:
+        messages = scan_messages(data)
+    for global_number in (SPORT, SESSION):
+        for definition, (offsets, timestamps) in messages.items():
+            if definition.global_number != global_number or not offsets:
+                continue
+            field = 0 if global_number == SPORT else 5
+            values = decode(data, definition, offsets[:1], {field: 'sport'})
+            if 'sport' in values.dtype.names:
+                sport = int(values['sport'][0])
+                return SPORTS.get(sport, 'Other')
+    raise FitError('No sport found')
+
+
+def read_activity_type(filename):
+    with open(filename, 'rb') as f:
+        return read_sport(f.read())
+
+
+def records_frame(data, messages, cadence_scale=None, position=True):
+    '''Trackpoint frame of all record messages, in file order.'''
+    wanted = dict((number, field[0])
+                  for number, field in RECORD_FIELDS.items())
+    parts = []
+    for definition, (offsets, timestamps) in messages.items():
+        if definition.global_number != RECORD or not offsets:
+            continue
+        records = decode(data, definition, offsets, wanted)
+        part = {'order': np.asarray(offsets),
+                'compressed_timestamp': np.asarray(timestamps)}
+        for number, (name, scale, offset) in RECORD_FIELDS.items():
+            if name in records.dtype.names:
+                part[name] = field_values(records, name, scale, offset)
+            else:
+                part[name] = np.full(len(records), np.nan)
+        parts.append(pd.DataFrame(part))
+    if not parts:
+        raise FitError('No records found')
+    records = pd.concat(parts, ignore_index=True).sort_values('order')
+
+    # Compressed timestamps are resolved by scan_messages
+    compressed = records['compressed_timestamp'].values
+    timestamp = np.where(compressed >= 0, compressed,
+                         records['timestamp'].values)
+
+    time = pd.to_datetime(timestamp + FIT_EPOCH, unit='s', utc=True)
+    data = {'Time': time.astype(parse_tcx.TIME_DTYPE)}
+    for column, names in COLUMN_FIELDS.items():
+        values = records[names[0]].values
+        for name in names[1:]:
+            values = np.where(np.isfinite(values), values,
+                              records[name].values)
+        data[column] = values
+    if cadence_scale is None:
+        data['Cadence'] = np.full(len(records), np.nan)
+    else:
+        data['Cadence'] = cadence_scale*data['Cadence']
+    if not position:
+        data['Latitude'] = np.full(len(records), np.nan)
+        data['Longitude'] = np.full(len(records), np.nan)
+    return pd.DataFrame(data, columns=['Time'] + parse_tcx.TRACKPOINT_COLUMNS)
+
+
+def load_fit_data(filename):
+    '''Activity data of a FIT file, with the columns of load_tcx_data.
+
+    filename can also be a binary file object.
+    '''
+    with instrument.stage('parse_fit', filename):
+        if hasattr(filename, 'read'):
+            data = filename.read()
+        else:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        messages = scan_messages(data)
+        activity_type = read_sport(data, messages)
+        print('Activity type: ', activity_type)
+        cadence_scale, position = parse_tcx.get_parser_options(activity_type)
+        df = records_frame(data, messages, cadence_scale, position)
+        df = df[df['Time'].notnull()].reset_index(drop=True)
+
+    with instrument.stage('derived_columns', filename):
+        return parse_tcx.add_derived_columns(df)
+
+
+def crc(data, value=0):
+    '''FIT CRC-16 of data.'''
+    for byte in bytearray(data):
+        for nibble in (byte & 0x0F, byte >> 4):
+            tmp = _CRC_TABLE[value & 0x0F]
+            value = (value >> 4) & 0x0FFF
+            value = value ^ tmp ^ _CRC_TABLE[nibble]
+    return value
+
+
+_CRC_TABLE = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+              0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+
+
+if __name__ == '__main__':
+    df = load_fit_data(sys.argv[1])
+    print(df.describe())
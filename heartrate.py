@@ -10,36 +10,118 @@ Threshold, Kavonen, Five Zone Method, ...
 import sys
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from scipy import interpolate
 import parse_tcx
 
-pd.options.display.mpl_style = 'default'
-
-def get_time_in_zones(hrseries, zones):
-    '''Calculate total time in each given heart rate zone.'''
-    #Interpolate to constant time segments
-    tstart = hrseries.index[0]
-    tend = hrseries.index[-1]
-    ntimes = hrseries.size
-    interp_times = np.linspace(tstart, tend, ntimes)
-    print(tstart, tend)
-    dt = interp_times[1] - interp_times[0]
-    hrseries_interp = interpolate.UnivariateSpline(hrseries.index,
-                                                   hrseries,
-                                                   s=0.0, k=3)
-    hrseries_interp = hrseries_interp(interp_times)
-
-    counts, bins = np.histogram(hrseries, bins=[0] + list(zones))
-    tiz = pd.DataFrame(index=zones.index,
-                       columns=['ZoneStart', 'ZoneEnd', 'TimeInZone'])
-    tiz['TimeInZone'] = counts / counts.sum()*100
-    tiz['ZoneStart'][1:] = zones[:-1]
-    tiz['ZoneEnd'][:] = zones[:]
+def sample_durations(times, max_dt=None):
+    '''Time in seconds represented by each sample of a series.
+
+    Every sample lasts until the next one, the last sample gets no time.
+    Gaps longer than max_dt, e.g. pauses, are not counted.
+    '''
+    times = np.asarray(times, dtype=float)
+    dt = np.zeros(times.shape)
+    dt[:-1] = np.diff(times)
+    if max_dt is not None:
+        dt[dt > max_dt] = 0
+    return dt
+
+
+def zone_edges(zones):
+    '''Bin edges of zones, starting at 0 bpm.'''
+    return np.concatenate([[0], np.asarray(zones, dtype=float)])
+
+
+def _bin_index(hr, edges):
+    # Bin of each heart rate, -1 if outside the edges. As in np.histogram,
+    # the last bin includes its upper edge.
+    index = np.searchsorted(edges, hr, side='right') - 1
+    index[hr == edges[-1]] = len(edges) - 2
+    index[~np.isfinite(hr) | (index >= len(edges) - 1)] = -1
+    return index
 
+
+def _zone_table(zones, seconds):
+    tiz = pd.DataFrame(index=zones.index,
+                       columns=['ZoneStart', 'ZoneEnd', 'TimeInZone',
+                                'Seconds'])
+    tiz['ZoneStart'] = zone_edges(zones)[:-1]
+    tiz['ZoneEnd'] = zones.values
+    total = seconds.sum()
+    tiz['TimeInZone'] = seconds / total*100 if total > 0 else 0.0
+    tiz['Seconds'] = seconds
     return tiz
 
 
+def get_time_in_zones(hrseries, zones, max_dt=None):
+    '''Calculate total time in each given heart rate zone.
+
+    hrseries is indexed by elapsed seconds. Each sample is weighted by its
+    duration, so irregular sampling does not bias the result. TimeInZone is
+    given in percent, Seconds in seconds.
+    '''
+    return get_time_in_zones_multi(hrseries, {'zones': zones},
+                                   max_dt)['zones']
+
+
+def get_time_in_zones_multi(hrseries, zone_sets, max_dt=None):
+    '''Time in zones for several zone definitions in a single pass.
+
+    zone_sets maps names to zones, e.g. from get_zones_lactate_thresh or
+    get_zones_kavonen_five. Returns a dict of get_time_in_zones tables.
+    '''
+    hr = np.asarray(hrseries, dtype=float)
+    dt = sample_durations(hrseries.index, max_dt)
+
+    # Bin once on the union of all zone edges, then sum up per zone set
+    edges = np.unique(np.concatenate([zone_edges(zones)
+                                      for zones in zone_sets.values()]))
+    index = _bin_index(hr, edges)
+    valid = index >= 0
+    seconds = np.bincount(index[valid], weights=dt[valid],
+                          minlength=len(edges) - 1)
+    cumulative = np.concatenate([[0], np.cumsum(seconds)])
+
+    tables = {}
+    for name, zones in zone_sets.items():
+        bounds = np.searchsorted(edges, zone_edges(zones))
+        tables[name] = _zone_table(zones, np.diff(cumulative[bounds]))
+    return tables
+
+
+def get_time_in_zones_batch(activities, zones, max_dt=None):
+    '''Seconds in each zone for many activities in one vectorized call.
+
+    activities maps activity ids to frames with SecondsElapsed and
+    HeartRateBpm columns (a list is indexed by position). Returns a
+    DataFrame with one row per activity and one column per zone.
+    '''
+    if not hasattr(activities, 'keys'):
+        activities = dict(enumerate(activities))
+    keys = list(activities.keys())
+    lengths = np.array([len(activities[k]) for k in keys], dtype=int)
+    nzones = len(zones)
+    if lengths.sum() == 0:
+        return pd.DataFrame(np.zeros((len(keys), nzones)), index=keys,
+                            columns=zones.index)
+
+    times = np.concatenate([np.asarray(activities[k]['SecondsElapsed'],
+                                       dtype=float) for k in keys])
+    hr = np.concatenate([np.asarray(activities[k]['HeartRateBpm'],
+                                    dtype=float) for k in keys])
+    owner = np.repeat(np.arange(len(keys)), lengths)
+
+    dt = sample_durations(times, max_dt)
+    # The last sample of every activity gets no time
+    dt[np.cumsum(lengths)[lengths > 0] - 1] = 0
+
+    index = _bin_index(hr, zone_edges(zones))
+    valid = index >= 0
+    seconds = np.bincount(owner[valid]*nzones + index[valid],
+                          weights=dt[valid], minlength=len(keys)*nzones)
+    return pd.DataFrame(seconds.reshape(len(keys), nzones), index=keys,
+                        columns=zones.index)
+
+
 def get_zones_lactate_thresh(lt, hrmin, hrmax):
     '''Calculate the five zones based on lactate threshold (LT)'''
     zones_dict = {'Recovery': 0.8*lt,
@@ -49,7 +131,7 @@ def get_zones_lactate_thresh(lt, hrmin, hrmax):
                   'VO2Max': 1.05*lt,
                   'Speed': hrmax}
     zones = pd.Series(zones_dict)
-    zones.sort(inplace=True)
+    zones = zones.sort_values()
     return zones
 
 
@@ -61,11 +143,13 @@ def get_zones_kavonen_five(hrmin, hrmax):
                   'Anaerobic': hrmin + 0.9*hrr,
                   'Redline': hrmin + hrr}
     zones = pd.Series(zones_dict)
-    zones.sort(inplace=True)
+    zones = zones.sort_values()
     return zones
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import density
     hrmin = float(sys.argv[2])
     hrmax = float(sys.argv[3])
     lt = float(sys.argv[4])
@@ -74,14 +158,19 @@ if __name__ == '__main__':
     hrseries = pd.Series(index=times, data=df['HeartRateBpm'].values)
     zones = get_zones_lactate_thresh(lt, hrmin, hrmax)
     zones_kavonen = get_zones_kavonen_five(hrmin, hrmax)
-    tiz = get_time_in_zones(hrseries, zones)
-    tizkav = get_time_in_zones(hrseries, zones_kavonen)
+    tables = get_time_in_zones_multi(hrseries, {'lt': zones,
+                                                'kavonen': zones_kavonen})
+    tiz = tables['lt']
+    tizkav = tables['kavonen']
     fig, ax = plt.subplots(1, 3, figsize=(15,5))
     tiz['TimeInZone'].plot(ax=ax[0], kind='barh')
     tizkav['TimeInZone'].plot(ax=ax[1], kind='barh')
-    df['HeartRateBpm'].plot(ax=ax[2], kind='kde')
-    df['HeartRateBpm'].plot(ax=ax[2], kind='hist', normed=True,
-        bins=np.linspace(hrmin, hrmax, (hrmax-hrmin)//2), alpha=0.3)
+    # Binned density, a Gaussian KDE over every sample is too slow
+    grid, hrdensity = density.column_density(df['HeartRateBpm'].values,
+                                             'HeartRateBpm')
+    ax[2].plot(grid, hrdensity)
+    df['HeartRateBpm'].plot(ax=ax[2], kind='hist', density=True,
+        bins=np.linspace(hrmin, hrmax, int((hrmax-hrmin)//2)), alpha=0.3)
     print(tiz)
     print(tizkav)
     plt.tight_layout()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Archive-wide heatmap of activity positions.
+
+Positions are binned into a fixed grid in Web Mercator coordinates, the
+projection of the map tiles, chunk by chunk as they are read from the
+consolidated activity store. Memory use depends on the grid size and the
+chunk size, not on the number of points. The log-scaled counts are drawn as
+a single image over the map.
+
+Usage: python heatmap.py <activities.h5> <output.png> [sport]
+'''
+import sys
+import numpy as np
+import tiles
+import instrument
+
+
+#: Default number of (rows, columns) of the heatmap grid.
+SHAPE = (1000, 1000)
+
+EARTH_RADIUS = 6378137.0
+
+
+def mercator(lon, lat):
+    '''Web Mercator x, y in meters of longitudes and latitudes.'''
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -85.05, 85.05)
+    x = EARTH_RADIUS*np.radians(lon)
+    y = EARTH_RADIUS*np.log(np.tan(np.pi/4 + np.radians(lat)/2))
+    return x, y
+
+
+class Heatmap(object):
+    '''Counts of positions on a regular grid over a lon/lat extent.'''
+
+    def __init__(self, extent, shape=SHAPE):
+        self.extent = tuple(float(e) for e in extent)
+        self.shape = tuple(shape)
+        lon_min, lon_max, lat_min, lat_max = self.extent
+        x0, y0 = mercator(lon_min, lat_min)
+        x1, y1 = mercator(lon_max, lat_max)
+        self.xy_extent = (float(x0), float(x1), float(y0), float(y1))
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+
+    def add(self, lon, lat):
+        '''Bin positions, those outside the extent or missing are ignored.'''
+        x, y = mercator(lon, lat)
+        x0, x1, y0, y1 = self.xy_extent
+        nrows, ncols = self.shape
+        j = np.floor((x - x0)/(x1 - x0)*ncols)
+        i = np.floor((y - y0)/(y1 - y0)*nrows)
+        inside = (i >= 0) & (i < nrows) & (j >= 0) & (j < ncols)
+        # NaN positions compare False and are left out as well
+        flat = i[inside].astype(np.int64)*ncols + j[inside].astype(np.int64)
+        self.counts += np.bincount(flat, minlength=nrows*ncols).reshape(
+            self.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def image(self):
+        '''Log-scaled counts, with NaN for empty cells.'''
+        image = np.log1p(self.counts.astype(float))
+        image[self.counts == 0] = np.nan
+        return image
+
+
+def store_extent(store, sport=None, start=None, end=None, margin=0.05):
+    '''Extent of all positions in the store, read in chunks.'''
+    lon_min = lat_min = np.inf
+    lon_max = lat_max = -np.inf
+    for chunk in store.iter_chunks(sport, start, end,
+                                   columns=['Latitude', 'Longitude']):
+        lon = chunk['Longitude'].values
+        lat = chunk['Latitude'].values
+        if np.isfinite(lon).any():
+            lon_min = min(lon_min, np.nanmin(lon))
+            lon_max = max(lon_max, np.nanmax(lon))
+            lat_min = min(lat_min, np.nanmin(lat))
+            lat_max = max(lat_max, np.nanmax(lat))
+    if not np.isfinite(lon_min):
+        return None
+    return tiles.map_extent([lon_min, lon_max], [lat_min, lat_max], margin)
+
+
+def archive_heatmap(store, extent=None, shape=SHAPE, sport=None, start=None,
+                    end=None):
+    '''Heatmap of the stored activities, by default over all positions.'''
+    if extent is None:
+        extent = store_extent(store, sport, start, end)
+        if extent is None:
+            raise RuntimeError('No positions in {0}'.format(store.path))
+    heatmap = Heatmap(extent, shape)
+    for chunk in store.iter_chunks(sport, start, end,
+                                   columns=['Latitude', 'Longitude']):
+        with instrument.stage('aggregate'):
+            heatmap.add(chunk['Longitude'].values, chunk['Latitude'].values)
+    return heatmap
+
+
+def heatmap_figure(heatmap, tiler=None, basemap=True, cmap='hot'):
+    '''Draw a heatmap as one image, over map tiles if basemap is True.'''
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(10, 10))
+    if basemap:
+        # Maps need cartopy, only import it when asked for
+        import activitymap
+        if tiler is None:
+            tiler = activitymap.get_tiler()
+        ax = fig.add_subplot(1, 1, 1, projection=tiler.crs)
+        ax.set_extent(heatmap.extent)
+        ax.add_image(tiler, tiles.zoom_for_extent(heatmap.extent))
+        transform = dict(transform=tiler.crs)
+    else:
+        ax = fig.add_subplot(1, 1, 1)
+        ax.set_aspect('equal')
+        ax.set_xticks([])
+        ax.set_yticks([])
+        transform = {}
+    im = ax.imshow(heatmap.image(), extent=heatmap.xy_extent, origin='lower',
+                   cmap=cmap, alpha=0.8, interpolation='nearest',
+                   **transform)
+    cbar = plt.colorbar(im, shrink=.5)
+    cbar.set_label('log(1 + points)')
+    return fig
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('agg')
+    import activity_store
+    store = activity_store.ActivityStore(sys.argv[1])
+    sport = sys.argv[3] if len(sys.argv) > 3 else None
+    fig = heatmap_figure(archive_heatmap(store, sport=sport))
+    fig.savefig(sys.argv[2], dpi=150)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+Batch ingestion of tcx files, spread over a pool of worker processes.
+
+Every file is parsed (or loaded from the activity cache) in a worker. A failing
+file is reported in its result instead of aborting the whole batch, and
+results always come back in the order the files were given.
+
+File names can be members of zip archives, as listed by archive.expand,
+which are streamed from the archive without extracting them.
+'''
+import sys
+import multiprocessing
+import traceback
+import archive
+import fingerprint
+import parse_tcx
+import instrument
+
+
+class IngestResult(object):
+    '''Outcome of ingesting a single tcx file.'''
+
+    def __init__(self, filename, df=None, error=None, key=None, sport=None):
+        self.filename = filename
+        self.df = df
+        self.error = error
+        self.key = key
+        self.sport = sport
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def skipped(self):
+        '''True for files of a sport the parser does not read.'''
+        return self.ok and self.df is None
+
+
+#: Cache name of the marker of files of unsupported sports.
+UNSUPPORTED_NAME = 'Unsupported'
+
+
+def is_unsupported(cache, key):
+    '''True if the file of cache key was found to be of an unsupported
+    sport.'''
+    return cache.load_key_json(key, UNSUPPORTED_NAME) is not None
+
+
+def ingest_file(filename, cache_dir, columns=None, compact=False):
+    '''Load a tcx file through the activity cache in cache_dir.
+
+    Only the given columns are returned, to keep the transfer from the
+    worker process small. compact=True returns the frame with compact dtypes,
+    see parse_tcx.compact.
+    '''
+    try:
+        cache = parse_tcx.get_cache(cache_dir)
+        # The sport is read first, other sports are skipped without parsing
+        sport = parse_tcx.read_activity_type(filename)
+        if sport not in parse_tcx.SPORTS:
+            return IngestResult(filename, key=cache.key(filename),
+                                sport=sport)
+        if compact:
+            # Compacted again for older cache entries with float
+            # SecondsElapsed, all frames of a store must share dtypes
+            df = parse_tcx.compact(cache.get(
+                filename, parse_tcx.load_compact_data,
+                parse_tcx.COMPACT_NAME))
+        else:
+            df = cache.get(filename, parse_tcx.load_activity_data)
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return IngestResult(filename, df, key=cache.key(filename),
+                            sport=sport)
+    except Exception:
+        return IngestResult(filename, error=traceback.format_exc())
+
+
+def _ingest_worker(args):
+    return ingest_file(*args)
+
+
+def iter_ingest(filenames, cache_dir, processes=None, columns=None,
+                progress=True, compact=False):
+    '''Ingest tcx files in parallel, yielding an IngestResult per file.
+
+    Results are yielded in the order of filenames. processes=1 runs in the
+    calling process, None uses one worker per CPU.
+    '''
+    tasks = [(filename, cache_dir, columns, compact)
+             for filename in filenames]
+    pool = None
+    if processes == 1:
+        results = map(_ingest_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_ingest_worker, tasks)
+
+    try:
+        for i, result in enumerate(results):
+            if progress:
+                if result.skipped:
+                    status = 'skipped, {0}'.format(result.sport)
+                else:
+                    status = 'ok' if result.ok else 'FAILED'
+                print('[{0}/{1}] {2}: {3}'.format(i + 1, len(tasks),
+                                                 result.filename, status))
+                if not result.ok:
+                    print(result.error)
+            yield result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def ingest_files(filenames, cache_dir, processes=None, columns=None,
+                 progress=True, compact=False):
+    '''Ingest tcx files in parallel and return the list of results.'''
+    return list(iter_ingest(filenames, cache_dir, processes, columns,
+                            progress, compact))
+
+
+def update_store(store, filenames, cache_dir, processes=None,
+                 progress=True, compact=False):
+    '''Add the activities of filenames that are not in store yet.
+
+    Returns the activity ids of all filenames, in order, with None for files
+    that could not be read. Files of sports the parser does not read are
+    skipped, and marked in the cache so they are not read again. New
+    activities are fingerprinted, and duplicates
+    of stored activities are reported, see fingerprint. With compact=True
+    activities are stored with compact dtypes, which all activities of a
+    store must share.
+    '''
+    cache = parse_tcx.get_cache(cache_dir)
+    ids = []
+    for filename in filenames:
+        try:
+            ids.append(cache.key(filename))
+        except (IOError, OSError):
+            ids.append(None)
+    known = store.activity_ids()
+    # Files of unsupported sports are remembered by key, and never read
+    # again while they are unchanged
+    new = [f for f, key in zip(filenames, ids)
+           if key is not None and key not in known and
+           not is_unsupported(cache, key)]
+    if not new:
+        return ids
+    # Fingerprints of new activities are checked against the stored ones
+    path = fingerprint.index_path(store)
+    fingerprints = fingerprint.get_index(store, path)
+    for result in iter_ingest(new, cache_dir, processes, progress=progress,
+                              compact=compact):
+        # The store is written from this process only, HDF5 files do not
+        # support concurrent writers
+        if result.skipped:
+            cache.store_key_json(result.key, UNSUPPORTED_NAME,
+                                 {'sport': result.sport})
+        elif result.ok and result.key not in known:
+            try:
+                with instrument.stage('store_write', result.filename):
+                    store.add(result.key, result.sport, result.df,
+                              source=result.filename)
+            except Exception:
+                # e.g. a frame that does not match the partition's tables
+                print('{0}: not stored\n{1}'.format(result.filename,
+                                                     traceback.format_exc()))
+                continue
+            known.add(result.key)
+            row = fingerprints.add(result.key, result.sport, result.df)
+            if row['DuplicateOf']:
+                print('{0}: duplicate of {1}'.format(result.filename,
+                                                     row['DuplicateOf']))
+            elif row['Overlaps']:
+                print('{0}: overlaps {1}'.format(result.filename,
+                                                 row['Overlaps']))
+    fingerprints.save(path)
+    return ids
+
+
+if __name__ == '__main__':
+    # Usage: python ingest.py cache_dir file1.tcx [export.zip ...]
+    cache_dir = sys.argv[1]
+    results = ingest_files(archive.expand(sys.argv[2:]), cache_dir, columns=[])
+    skipped = [r.filename for r in results if r.skipped]
+    failed = [r.filename for r in results if not r.ok]
+    print('{0} files ingested, {1} skipped, {2} failed'.format(
+        len(results) - len(skipped) - len(failed), len(skipped),
+        len(failed)))
+    for filename in failed:
+        print('  ' + filename)
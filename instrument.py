@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+Per-stage timing and memory instrumentation of the analysis pipeline.
+
+Pipeline code marks its stages with
+
+    with instrument.stage('parse', filename):
+        ...
+
+Instrumentation is off by default, and stage then returns a shared no-op
+context manager. Once enabled (enable, or the PYGARMIN_TRACE environment
+variable naming a .json or .csv trace file), every stage records its wall
+time and, with memory=True (PYGARMIN_TRACE_MEMORY=1), its peak traced
+memory. Records are written as a trace file and summed up per stage in a
+summary table.
+
+Only the current process is traced, run parallel tools with one process
+(-j 1) to see the stages of worker processes.
+'''
+import os
+import csv
+import sys
+import json
+import time
+import atexit
+import tracemalloc
+import contextlib
+import multiprocessing
+
+
+FIELDS = ['stage', 'activity', 'start', 'seconds', 'peak_mb']
+
+# Records of the current run, None while instrumentation is disabled
+_records = None
+_memory = False
+# Highest traced memory seen in each open stage, innermost last
+_peaks = []
+_null = contextlib.nullcontext()
+
+
+def enabled():
+    return _records is not None
+
+
+def enable(memory=False):
+    '''Start recording stages, with peak memory if memory is True.'''
+    global _records, _memory
+    _records = []
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    '''Stop recording and return the records.'''
+    global _records
+    records, _records = _records, None
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return records or []
+
+
+def records():
+    return list(_records or [])
+
+
+@contextlib.contextmanager
+def _stage(name, activity):
+    if _memory:
+        # Keep the peak of the enclosing stage before resetting it
+        current, peak = tracemalloc.get_traced_memory()
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+        tracemalloc.reset_peak()
+        base = current
+        _peaks.append(current)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = dict(stage=name,
+                      activity=None if activity is None
+                      # File objects of streamed activities have a name
+                      else os.path.basename(str(getattr(activity, 'name',
+                                                        activity))),
+                      start=start, seconds=time.perf_counter() - start,
+                      peak_mb=None)
+        if _memory:
+            peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+            record['peak_mb'] = (peak - base)/1024.0**2
+        if _records is not None:
+            _records.append(record)
+
+
+def stage(name, activity=None):
+    '''Context manager recording the stage name, e.g. of an activity file.'''
+    if _records is None:
+        return _null
+    return _stage(name, activity)
+
+
+def write_trace(path, records=None):
+    '''Write records as JSON, or as CSV if path ends with .csv.'''
+    if records is None:
+        records = _records or []
+    with open(path, 'w') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, f, indent=1)
+
+
+def summary(records=None):
+    '''Rows of (stage, count, total, mean, max seconds, max peak MB),
+    slowest stage first.'''
+    if records is None:
+        records = _records or []
+    stages = {}
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r)
+    rows = []
+    for name, rs in stages.items():
+        seconds = [r['seconds'] for r in rs]
+        peaks = [r['peak_mb'] for r in rs if r['peak_mb'] is not None]
+        rows.append((name, len(rs), sum(seconds), sum(seconds)/len(rs),
+                     max(seconds), max(peaks) if peaks else None))
+    return sorted(rows, key=lambda row: -row[2])
+
+
+def print_summary(records=None, file=None):
+    '''Print the summary table of the recorded stages.'''
+    file = sys.stdout if file is None else file
+    file.write('{0:<20} {1:>6} {2:>10} {3:>10} {4:>10} {5:>9}\n'.format(
+        'stage', 'count', 'total [s]', 'mean [s]', 'max [s]', 'peak [MB]'))
+    for name, count, total, mean, longest, peak in summary(records):
+        file.write('{0:<20} {1:>6} {2:10.4f} {3:10.4f} {4:10.4f} {5:>9}\n'
+                   .format(name, count, total, mean, longest,
+                           '' if peak is None else '{0:.1f}'.format(peak)))
+
+
+def _finish(path):
+    write_trace(path)
+    print_summary(file=sys.stderr)
+
+
+def enable_from_environment():
+    '''Enable instrumentation if PYGARMIN_TRACE names a trace file.
+
+    The trace is written and the summary printed when the process exits.
+    '''
+    path = os.environ.get('PYGARMIN_TRACE')
+    # Worker processes must not overwrite the trace of the main process
+    if multiprocessing.parent_process() is not None:
+        return
+    if path and not enabled():
+        enable(os.environ.get('PYGARMIN_TRACE_MEMORY', '') not in ('', '0'))
+        atexit.register(_finish, path)
+
+
+enable_from_environment()
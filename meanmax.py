@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Mean-maximal (best effort) curves of heart rate, speed and cadence.
+
+The curve of a metric gives, for each window length, the best average of the
+metric over any window of that length in the activity. Data is put on a
+regular time grid first, so the average over every window follows from a
+difference of cumulative sums, and a curve costs O(n) per window length.
+Windows spanning a pause, see parse_tcx.resample, are left out.
+
+Per-activity curves are cached with the activity data, and the best efforts
+of an archive are the elementwise maximum of the cached curves.
+'''
+import sys
+import numpy as np
+import pandas as pd
+import parse_tcx
+
+
+#: Window lengths in seconds, log-spaced from 5 s to 2 h.
+WINDOWS = np.unique(np.round(np.logspace(np.log10(5), np.log10(7200),
+                                         40)).astype(int))
+
+COLUMNS = ['HeartRateBpm', 'Speed', 'Cadence']
+
+#: Version of the cached curves, bump it when they change.
+CURVES_VERSION = 2
+
+CACHE_NAME = 'MeanMax-v{0}'.format(CURVES_VERSION)
+
+
+def cumulative_on_grid(seconds, values, step=1.0, max_gap=parse_tcx.MAX_GAP):
+    '''Cumulative sums of values interpolated onto a regular time grid, and
+    of the grid points inside pauses, where values count as 0.'''
+    seconds = np.asarray(seconds, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(seconds) & np.isfinite(values)
+    if valid.sum() < 2:
+        return np.zeros(1), np.zeros(1)
+    seconds, values = seconds[valid], values[valid]
+    grid = np.arange(seconds[0], seconds[-1] + step/2, step)
+    gap = parse_tcx.gap_mask(seconds, grid, max_gap)
+    values = np.where(gap, 0.0, np.interp(grid, seconds, values))
+    return (np.concatenate([[0], np.cumsum(values)]),
+            np.concatenate([[0], np.cumsum(gap)]))
+
+
+def mean_maximal(cumulative, windows, step=1.0, gaps=None):
+    '''Best average for each window length (seconds) from a cumulative sum.
+
+    gaps is the cumulative sum of the grid points inside pauses, windows
+    holding any of them are left out. Windows longer than the data, or
+    without a window free of pauses, give NaN.
+    '''
+    best = np.full(len(windows), np.nan)
+    npoints = len(cumulative) - 1
+    for i, window in enumerate(windows):
+        w = int(round(window/step))
+        if 0 < w <= npoints:
+            sums = cumulative[w:] - cumulative[:-w]
+            if gaps is not None:
+                sums = sums[gaps[w:] == gaps[:-w]]
+            if sums.size:
+                best[i] = np.max(sums)/w
+    return best
+
+
+def activity_curves(df, windows=WINDOWS, step=1.0):
+    '''Mean-maximal curves of an activity, one column per metric.'''
+    curves = pd.DataFrame(index=pd.Index(windows, name='Seconds'))
+    df = parse_tcx.expand(df)
+    seconds = df['SecondsElapsed'].values
+    for column in COLUMNS:
+        if column == 'Speed' and 'DistanceMeters' in df.columns:
+            # The average speed over a window follows directly from the
+            # distance covered, which is far less noisy than Speed
+            distance = df['DistanceMeters'].values
+            valid = np.isfinite(seconds) & np.isfinite(distance)
+            if valid.sum() < 2:
+                cumulative, gaps = np.zeros(1), np.zeros(1)
+            else:
+                grid = np.arange(seconds[valid][0],
+                                 seconds[valid][-1] + step/2, step)
+                gap = parse_tcx.gap_mask(seconds[valid], grid)
+                cumulative = 3.6/step*np.interp(grid, seconds[valid],
+                                                distance[valid])
+                cumulative = cumulative - cumulative[0]
+                # Steps from or to a point inside a pause are in the pause
+                gaps = np.concatenate([[0], np.cumsum(gap[1:] | gap[:-1])])
+        elif column in df.columns:
+            cumulative, gaps = cumulative_on_grid(seconds, df[column].values,
+                                                  step)
+        else:
+            cumulative, gaps = np.zeros(1), np.zeros(1)
+        curves[column] = mean_maximal(cumulative, windows, step, gaps)
+    return curves
+
+
+def get_activity_curves(filename, cache_dir=None):
+    '''Mean-maximal curves of a tcx file, through the activity cache.'''
+    cache = parse_tcx.get_cache(cache_dir)
+    curves = cache.load(filename, CACHE_NAME)
+    if curves is None or not np.array_equal(curves.index, WINDOWS):
+        curves = activity_curves(parse_tcx.get_activity_data(filename,
+                                                             cache_dir))
+        cache.store(filename, curves, CACHE_NAME)
+    return curves
+
+
+def archive_curves(store, cache, ids=None, sport=None):
+    '''Best efforts over stored activities, from cached per-activity curves.
+
+    Curves are only computed for activities that do not have one cached.
+    '''
+    index = store.activities(sport)
+    if ids is not None:
+        index = index[index['ActivityId'].isin(list(ids))]
+    best = pd.DataFrame(np.nan, index=pd.Index(WINDOWS, name='Seconds'),
+                        columns=COLUMNS)
+    missing = []
+    for activity_id in index['ActivityId']:
+        curves = cache.load_key(activity_id, CACHE_NAME)
+        if curves is None or not np.array_equal(curves.index, WINDOWS):
+            missing.append(activity_id)
+        else:
+            best = np.fmax(best, curves[COLUMNS])
+
+    columns = ['SecondsElapsed', 'DistanceMeters'] + COLUMNS
+    for activity_id, df in store.iter_activities(sport, ids=missing,
+                                                 columns=columns):
+        curves = activity_curves(df)
+        cache.store_key(activity_id, curves, CACHE_NAME)
+        best = np.fmax(best, curves[COLUMNS])
+    return best
+
+
+if __name__ == '__main__':
+    curves = [get_activity_curves(filename) for filename in sys.argv[1:]]
+    best = curves[0]
+    for c in curves[1:]:
+        best = np.fmax(best, c)
+    print(best)
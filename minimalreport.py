@@ -3,56 +3,82 @@
 Create a minimal report (figures, html document) of a Garmin activity.
 '''
 import sys
-import os
 import matplotlib
-import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import parse_tcx
+import instrument
 
 
-def get_activity_data(filename):
-    # Load TCX file activity data.
-    # Then store it as a HDF5 file.
-    # If HDF5 file already exists, load data from there.
-    basename = filename[:-4]
-    filename_df = basename + '.h5'
-    if os.path.exists(filename_df):
-        print('Loading data from HDF5 file')
-        df = pd.read_hdf(filename_df, 'ActivityData')
-    else:
-        df = parse_tcx.load_tcx_data(filename)
-        print('Storing data to HDF5 file: ', filename_df)
-        df.to_hdf(filename_df, 'ActivityData')
+class MinimalReportFigure(object):
+    '''Heart rate figure that can be redrawn for other activities.
 
+    The layout and artists are built once, update only swaps their data.
+    '''
 
-def minimal_report_figure(df):
-    '''Plot heart rate data'''
-    fig, axes = plt.subplots(1, 2, figsize=(12, 6))
-    df.plot(x='SecondsElapsed', y='HeartRateBpm', ax=axes[0],
-            linewidth=0.8, alpha=0.5)
-    hr_smoothed = pd.stats.moments.rolling_mean(df['HeartRateBpm'], 60)
-    axes[0].plot(df['SecondsElapsed'], hr_smoothed, linewidth=1.6)
-    df.hist(column='HeartRateBpm', ax=axes[1])
-    axes[0].set_ylabel('Heart rate [bpm]')
-    axes[1].set_xlabel('Heart rate [bpm]')
-    return fig
+    BINS = 10
 
+    def __init__(self, figsize=(12, 6)):
+        self.fig, self.axes = plt.subplots(1, 2, figsize=figsize)
+        self.raw, = self.axes[0].plot([], [], linewidth=0.8, alpha=0.5,
+                                      label='HeartRateBpm')
+        self.smoothed, = self.axes[0].plot([], [], linewidth=1.6)
+        self.axes[0].legend()
+        self.bars = self.axes[1].bar(np.zeros(self.BINS), np.zeros(self.BINS),
+                                     width=1.0, align='edge')
+        self.axes[1].set_title('HeartRateBpm')
+        self.axes[0].set_ylabel('Heart rate [bpm]')
+        self.axes[1].set_xlabel('Heart rate [bpm]')
 
-if __name__ == '__main__':
-    matplotlib.use('agg')
-    pd.options.display.mpl_style = 'default'
+    def update(self, df, resampled=None):
+        '''Draw the activity df and return the figure.
 
-    #Path to tcx file assumed to be passed as cmd line argument
-    filename = sys.argv[1]
+        resampled is df resampled by parse_tcx.resample, e.g. the cached
+        frame of parse_tcx.get_resampled_data. It is computed if not given.
+        '''
+        self.raw.set_data(df['SecondsElapsed'], df['HeartRateBpm'])
+        # On a 1 s grid the 60 sample rolling mean is a true one minute mean
+        if resampled is None:
+            resampled = parse_tcx.resample(df)
+        hr_smoothed = resampled['HeartRateBpm'].rolling(60, min_periods=30).mean()
+        self.smoothed.set_data(resampled['SecondsElapsed'], hr_smoothed)
+        hr = df['HeartRateBpm'].values
+        counts, edges = np.histogram(hr[np.isfinite(hr)], self.BINS)
+        for bar, count, left, right in zip(self.bars, counts, edges[:-1],
+                                           edges[1:]):
+            bar.set_x(left)
+            bar.set_width(right - left)
+            bar.set_height(count)
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        return self.fig
+
+
+def minimal_report_figure(df, resampled=None):
+    '''Plot heart rate data'''
+    return MinimalReportFigure().update(df, resampled)
+
+
+def main(filename):
     basename = filename[:-4]
-    df = get_activity_data(filename)
+    df = parse_tcx.get_activity_data(filename)
+    resampled = parse_tcx.get_resampled_data(filename)
 
     # Basic statistics as html document
     print('Basic statistics')
     df.describe().to_html(basename + '-statistics.html')
 
     print('Heart rate plot')
-    fig = minimal_report_figure(df)
-    fig.savefig(basename + '-heartrate.png')
+    with instrument.stage('figure', filename):
+        fig = minimal_report_figure(df, resampled)
+    with instrument.stage('render', filename):
+        fig.savefig(basename + '-heartrate.png')
     plt.close(fig)
 
+
+if __name__ == '__main__':
+    matplotlib.use('agg')
+
+    #Path to tcx file assumed to be passed as cmd line argument
+    main(sys.argv[1])
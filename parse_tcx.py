@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 '''
 Partial parser for Garmin Connect tcx files. Returns a Pandas DataFrame.
+
+FIT files are read by the fit module into the same DataFrame, see
+load_activity_data. Gzipped files and members of zip archives are read as
+streams, see the archive module.
 '''
-import os
 import sys
-import lxml.etree
 import numpy as np
 import pandas as pd
+import activity_cache
+import archive
+import instrument
+
+#: Version of the DataFrame layout produced by this parser. Bump it whenever
+#: the output changes, to invalidate all cached activity data.
+SCHEMA_VERSION = 3
 
 
 def get_activity_type(root, garmin_ns):
@@ -14,8 +23,34 @@ def get_activity_type(root, garmin_ns):
     return node.attrib['Sport']
 
 
+def is_fit(filename):
+    return archive.source_name(filename).lower().endswith('.fit')
+
+
+def read_activity_type(filename):
+    '''Sport of a TCX file, read without parsing the trackpoints.'''
+    if archive.is_stream(filename):
+        with archive.open_source(filename) as f:
+            if is_fit(filename):
+                import fit
+                return fit.read_sport(f.read())
+            return read_activity_type_stream(f, filename)
+    if is_fit(filename):
+        import fit
+        return fit.read_activity_type(filename)
+    return read_activity_type_stream(filename, filename)
+
+
+def read_activity_type_stream(source, filename):
+    import lxml.etree
+    for event, elem in lxml.etree.iterparse(source, events=('start',),
+                                            tag='{*}Activity'):
+        return elem.attrib['Sport']
+    raise RuntimeError('No activity found in {0}'.format(filename))
+
+
 def calculate_speed(distance, time):
-    dt = time.diff().astype('timedelta64[s]')
+    dt = time.diff()/np.timedelta64(1, 's')
     speed = 3.6*distance.diff()/dt
     return speed
 
@@ -27,102 +62,378 @@ def calculate_slope(distance, altitude):
     return slope
 
 
-def parse_cycling(root, garmin_ns):
-    df = pd.DataFrame()
-    for tp in root.findall(garmin_ns + 'Trackpoint'):
-        row_data = {}
-        for c in tp.getchildren():
-            name = c.tag.split('}')[1]
-            if 'Time' in name:
-                row_data[name] = pd.to_datetime(c.text)
-            elif 'Position' in name:
-                continue
-            elif 'HeartRateBpm' in name:
-                row_data[name] = float(c.getchildren()[0].text)
-            else:
-                try:
-                    row_data[name] = float(c.text)
-                except:
-                    pass
-        row = pd.Series(row_data)
-        df = df.append(row, ignore_index=True)
-
-        df['Cadence'] = np.nan
-    return df
+#: Numeric trackpoint columns, filled into preallocated float arrays.
+TRACKPOINT_COLUMNS = ['DistanceMeters', 'AltitudeMeters', 'HeartRateBpm',
+                      'Cadence', 'Latitude', 'Longitude']
 
 
-def parse_running(root, garmin_ns):
-    df = pd.DataFrame()
-    for tp in root.findall(garmin_ns + 'Trackpoint'):
-        row_data = {}
-        for c in tp.getchildren():
-            name = c.tag.split('}')[1]
-            if 'Time' in name:
-                row_data[name] = pd.to_datetime(c.text)
-            elif 'Position' in name:
-                tpx = c.getchildren()[0]
-                row_data['Latitude'] = float(c.getchildren()[0].text)
-                row_data['Longitude'] = float(c.getchildren()[1].text)
-            elif 'HeartRateBpm' in name:
-                row_data[name] = float(c.getchildren()[0].text)
-            elif 'Extensions' in name:
-                tpx = c.getchildren()[0]
-                for c2 in tpx:
+#: dtype of the Time column, as pd.to_datetime returns it for tcx times.
+#: Other sources convert to it, so frames of all sources can be combined.
+TIME_DTYPE = pd.to_datetime(['2015-01-01T00:00:00.000Z'],
+                            format='ISO8601').dtype
+
+
+def new_columns(npoints):
+    '''Preallocate column arrays for npoints trackpoints.
+
+    Missing values stay NaN. Time holds the raw ISO strings until the whole
+    activity has been read, see columns_to_frame.
+    '''
+    columns = dict((name, np.full(npoints, np.nan))
+                   for name in TRACKPOINT_COLUMNS)
+    columns['Time'] = np.empty(npoints, dtype=object)
+    return columns
+
+
+def read_trackpoint(tp, i, columns, cadence_scale=None, position=True):
+    '''Read a single Trackpoint element into row i of the column arrays.
+
+    Cadence is skipped if cadence_scale is None. The per foot cadence of
+    the TPX extension is multiplied by cadence_scale, a Cadence element is
+    read as is.
+    '''
+    for c in tp:
+        name = c.tag.split('}')[1]
+        if name == 'Time':
+            columns['Time'][i] = c.text
+        elif name == 'DistanceMeters' or name == 'AltitudeMeters':
+            columns[name][i] = float(c.text)
+        elif name == 'HeartRateBpm':
+            columns['HeartRateBpm'][i] = float(c[0].text)
+        elif name == 'Position':
+            if position:
+                columns['Latitude'][i] = float(c[0].text)
+                columns['Longitude'][i] = float(c[1].text)
+        elif name == 'Cadence':
+            if cadence_scale is not None:
+                columns['Cadence'][i] = float(c.text)
+        elif name == 'Extensions':
+            if cadence_scale is not None:
+                for c2 in c[0]:
                     if 'Cadence' in c2.tag:
-                        row_data['Cadence'] = 2*float(c2.text)
-            else:
-                try:
-                    row_data[name] = float(c.text)
-                except:
-                    pass
-        row = pd.Series(row_data)
-        df = df.append(row, ignore_index=True)
+                        columns['Cadence'][i] = cadence_scale*float(c2.text)
 
-    return df
+
+def columns_to_frame(columns, npoints=None):
+    '''Build a DataFrame from the first npoints rows of the column arrays.'''
+    data = dict((name, columns[name][:npoints])
+                for name in TRACKPOINT_COLUMNS)
+    # One vectorized conversion instead of pd.to_datetime per trackpoint.
+    # Files can mix times with and without fractional seconds, so the
+    # format is not inferred from the first one.
+    data['Time'] = pd.to_datetime(columns['Time'][:npoints], format='ISO8601')
+    return pd.DataFrame(data, columns=['Time'] + TRACKPOINT_COLUMNS)
+
+
+def parse_trackpoints(root, garmin_ns, cadence_scale=None, position=True):
+    '''Parse all trackpoints below root in a single pass.'''
+    trackpoints = root.findall(garmin_ns + 'Trackpoint')
+    columns = new_columns(len(trackpoints))
+    for i, tp in enumerate(trackpoints):
+        read_trackpoint(tp, i, columns, cadence_scale, position)
+    return columns_to_frame(columns)
 
 
-def load_tcx_data(filename):
-    root = lxml.etree.parse(filename).getroot()
-    garmin_ns = './/{{{0}}}'.format(root.nsmap[None])
-    activity_type = get_activity_type(root, garmin_ns)
-    print('Activity type: ', activity_type)
+#: Sports the parsers read, see get_parser_options.
+SPORTS = ('Running', 'Biking')
+
+
+def get_parser_options(activity_type):
+    '''Return the (cadence_scale, position) trackpoint options of a sport.'''
     if activity_type == 'Running':
-        df = parse_running(root, garmin_ns)
+        # Garmin stores running cadence per foot, report steps per minute
+        return 2.0, True
     elif activity_type == 'Biking':
-        df = parse_cycling(root, garmin_ns)
-    else:
-        raise RuntimeError('Activity not implemented yet: {0}'.format(activity_type))
+        # Cadence is not read for cycling
+        return None, True
+    raise RuntimeError('Activity not implemented yet: {0}'.format(activity_type))
+
+
+def parse_cycling(root, garmin_ns):
+    cadence_scale, position = get_parser_options('Biking')
+    return parse_trackpoints(root, garmin_ns, cadence_scale, position)
+
+
+def parse_running(root, garmin_ns):
+    cadence_scale, position = get_parser_options('Running')
+    return parse_trackpoints(root, garmin_ns, cadence_scale, position)
+
 
-    seconds_since = (df['Time'] - df['Time'][0]).astype('timedelta64[s]')
+def add_derived_columns(df, start_time=None, previous=None):
+    '''Add SecondsElapsed, Speed and Slope columns to a trackpoint frame.
+
+    When df is a chunk of a longer activity, start_time is the time of the
+    first trackpoint of the activity and previous the last row of the
+    preceding chunk, so that differences continue across chunk boundaries.
+    '''
+    if start_time is None:
+        start_time = df['Time'].iloc[0]
+    seconds_since = (df['Time'] - start_time)/np.timedelta64(1, 's')
     df['SecondsElapsed'] = seconds_since
 
-    speed = calculate_speed(df['DistanceMeters'], df['Time'])
-    df['Speed'] = speed
+    if previous is None:
+        ext, skip = df, 0
+    else:
+        ext = pd.concat([previous, df], ignore_index=True)
+        skip = len(previous)
+    speed = calculate_speed(ext['DistanceMeters'], ext['Time'])
+    df['Speed'] = speed.values[skip:]
 
-    slope = calculate_slope(df['DistanceMeters'], df['AltitudeMeters'])
-    df['Slope'] = slope
+    slope = calculate_slope(ext['DistanceMeters'], ext['AltitudeMeters'])
+    df['Slope'] = slope.values[skip:]
 
     return df
 
 
-def get_activity_data(filename):
-    # Load TCX file activity data.
-    # Then store it as a HDF5 file.
-    # If HDF5 file already exists, load data from there.
-    basename = filename[:-4]
-    filename_df = basename + '.h5'
-    if os.path.exists(filename_df):
-        print('Loading data from HDF5 file')
-        df = pd.read_hdf(filename_df, 'ActivityData')
+def load_tcx_data(filename, stream=False):
+    if stream:
+        # Never hold the full XML tree, only the resulting columns
+        with instrument.stage('parse_stream', filename):
+            return pd.concat(iter_tcx_chunks(filename), ignore_index=True)
+
+    # lxml is only needed on cache misses, keep it out of startup
+    import lxml.etree
+    with instrument.stage('parse_xml', filename):
+        root = lxml.etree.parse(filename).getroot()
+        garmin_ns = './/{{{0}}}'.format(root.nsmap[None])
+        activity_type = get_activity_type(root, garmin_ns)
+        print('Activity type: ', activity_type)
+        if activity_type == 'Running':
+            df = parse_running(root, garmin_ns)
+        elif activity_type == 'Biking':
+            df = parse_cycling(root, garmin_ns)
+        else:
+            raise RuntimeError('Activity not implemented yet: {0}'.format(activity_type))
+
+    with instrument.stage('derived_columns', filename):
+        return add_derived_columns(df)
+
+
+def load_activity_data(filename):
+    '''Activity data of a tcx or FIT file, by file extension.'''
+    if archive.is_stream(filename):
+        with archive.open_source(filename) as f:
+            if is_fit(filename):
+                import fit
+                return fit.load_fit_data(f)
+            return load_tcx_data(f)
+    if is_fit(filename):
+        import fit
+        return fit.load_fit_data(filename)
+    return load_tcx_data(filename)
+
+
+#: Number of trackpoints per chunk in streaming mode.
+CHUNKSIZE = 10000
+
+
+def iter_tcx_chunks(filename, chunksize=CHUNKSIZE):
+    '''Stream a TCX file as DataFrame chunks of at most chunksize trackpoints.
+
+    Built on lxml.etree.iterparse: every Trackpoint is cleared as soon as it
+    has been read, so peak memory depends on chunksize, not on the file size.
+    Chunks carry the same derived columns as load_tcx_data.
+    '''
+    import lxml.etree
+    context = lxml.etree.iterparse(filename, events=('start', 'end'),
+                                   tag=('{*}Activity', '{*}Trackpoint'))
+    columns = new_columns(chunksize)
+    cadence_scale, position = None, False
+    start_time = None
+    previous = None
+    n = 0
+    for event, elem in context:
+        if elem.tag.endswith('Activity'):
+            if event == 'start':
+                activity_type = elem.attrib['Sport']
+                print('Activity type: ', activity_type)
+                cadence_scale, position = get_parser_options(activity_type)
+            continue
+        if event != 'end':
+            continue
+
+        read_trackpoint(elem, n, columns, cadence_scale, position)
+        n += 1
+        # Drop the parsed element and any already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if n == chunksize:
+            df = columns_to_frame(columns, n)
+            if start_time is None:
+                start_time = df['Time'].iloc[0]
+            df = add_derived_columns(df, start_time, previous)
+            previous = df.iloc[-1:]
+            yield df
+            columns = new_columns(chunksize)
+            n = 0
+
+    if n > 0:
+        df = columns_to_frame(columns, n)
+        yield add_derived_columns(df, start_time, previous)
+
+
+#: Default interval in seconds of resampled activities.
+RESAMPLE_STEP = 1.0
+
+#: Gaps between samples longer than this many seconds are pauses, and are
+#: not interpolated over when resampling.
+MAX_GAP = 10.0
+
+
+def gap_mask(seconds, grid, max_gap=MAX_GAP):
+    '''True at the points of grid inside a pause, a gap of more than max_gap
+    seconds between the increasing sample times seconds.'''
+    before = np.searchsorted(seconds, grid, side='right') - 1
+    after = np.minimum(before + 1, len(seconds) - 1)
+    return (seconds[after] - seconds[before] > max_gap) & \
+        (grid > seconds[before])
+
+
+def resample(df, step=RESAMPLE_STEP, max_gap=MAX_GAP):
+    '''Resample an activity onto a regular time grid of step seconds.
+
+    Trackpoint columns are interpolated linearly. Grid points inside a pause,
+    a gap of more than max_gap seconds between samples, get NaN values and
+    Gap=True. Speed and Slope are recomputed on the grid.
+    '''
+    seconds = np.asarray(df['SecondsElapsed'], dtype=float)
+    grid = np.arange(seconds[0], seconds[-1] + step/2, step)
+    gap = gap_mask(seconds, grid, max_gap)
+
+    out = pd.DataFrame({'Time': df['Time'].iloc[0] +
+                        pd.to_timedelta(grid - seconds[0], unit='s')})
+    for name in TRACKPOINT_COLUMNS:
+        values = np.full(len(grid), np.nan)
+        if name in df.columns:
+            col = np.asarray(df[name], dtype=float)
+            valid = np.isfinite(col)
+            if valid.any():
+                values = np.interp(grid, seconds[valid], col[valid],
+                                   left=np.nan, right=np.nan)
+        values[gap] = np.nan
+        out[name] = values
+    out['Gap'] = gap
+
+    return add_derived_columns(out)
+
+
+#: Missing value of the integer columns of compact frames.
+MISSING = -1
+
+#: Column dtypes of compact frames. They never depend on the data, as all
+#: frames of a store partition must share them: SecondsElapsed is rounded to
+#: whole seconds, the exact times are kept in the Time column.
+COMPACT_DTYPES = {'HeartRateBpm': np.int16, 'Cadence': np.int16,
+                  'AltitudeMeters': np.float32, 'Speed': np.float32,
+                  'Slope': np.float32, 'Latitude': np.float64,
+                  'Longitude': np.float64, 'SecondsElapsed': np.int32}
+
+
+def compact(df):
+    '''Activity frame with small dtypes, see COMPACT_DTYPES.
+
+    Missing heart rate and cadence become MISSING. Values are rounded to
+    whole beats, steps and seconds. Compacting a compact frame changes
+    nothing.
+    '''
+    out = df.copy()
+    for name, dtype in COMPACT_DTYPES.items():
+        if name not in out.columns or out[name].dtype == dtype:
+            continue
+        values = out[name].values
+        if np.dtype(dtype).kind == 'i':
+            values = np.where(np.isfinite(values), np.round(values), MISSING)
+        out[name] = values.astype(dtype)
+    return out
+
+
+def expand(df):
+    '''Activity frame with the float64 columns of load_tcx_data.
+
+    Undoes compact, frames that are not compact are returned as they are.
+    '''
+    names = [name for name in COMPACT_DTYPES
+             if name in df.columns and df[name].dtype != np.float64]
+    if not names:
+        return df
+    out = df.copy()
+    for name in names:
+        values = out[name].values.astype(np.float64)
+        if name in ('HeartRateBpm', 'Cadence'):
+            values[values == MISSING] = np.nan
+        out[name] = values
+    return out
+
+
+#: Cache name of compact activity frames.
+COMPACT_NAME = 'ActivityDataCompact'
+
+
+def get_cache(cache_dir=None):
+    '''Activity cache for the output of this parser.'''
+    return activity_cache.ActivityCache(cache_dir, version=SCHEMA_VERSION)
+
+
+def get_activity_data(filename, cache_dir=None, compact=False):
+    # Load TCX file activity data through the activity cache, so the file is
+    # only parsed again when its content or the parser output changes.
+    # Compact frames are cached separately, with their dtypes.
+    if compact:
+        return get_compact_data(filename, cache_dir)
+    cache = get_cache(cache_dir)
+    with instrument.stage('cache_read', filename):
+        df = cache.load(filename)
+    if df is not None:
+        print('Loading data from cache file')
+    else:
+        df = load_activity_data(filename)
+        print('Storing data to cache file: ', cache.path(filename))
+        with instrument.stage('cache_write', filename):
+            cache.store(filename, df)
+
+    return df
+
+
+def load_compact_data(filename):
+    return compact(load_activity_data(filename))
+
+
+def get_compact_data(filename, cache_dir=None):
+    # Compact activity data, see compact. It is derived from cached full data
+    # if there is any, otherwise only the compact frame is cached.
+    cache = get_cache(cache_dir)
+    name = COMPACT_NAME
+    with instrument.stage('cache_read', filename):
+        df = cache.load(filename, name)
+    if df is not None:
+        # Older entries can have float SecondsElapsed
+        df = compact(df)
     else:
-        df = load_tcx_data(filename)
-        print('Storing data to HDF5 file: ', filename_df)
-        df.to_hdf(filename_df, 'ActivityData')
+        full = cache.load(filename)
+        df = load_compact_data(filename) if full is None else compact(full)
+        with instrument.stage('cache_write', filename):
+            cache.store(filename, df, name)
+
+    return df
+
+
+def get_resampled_data(filename, step=RESAMPLE_STEP, cache_dir=None):
+    # Resampled activity data, cached next to the raw data
+    cache = get_cache(cache_dir)
+    name = 'Resampled{0}ms'.format(int(round(step*1000)))
+    df = cache.load(filename, name)
+    if df is None:
+        df = get_activity_data(filename, cache_dir)
+        with instrument.stage('resample', filename):
+            df = resample(df, step)
+        cache.store(filename, df, name)
 
     return df
 
 
 if __name__ == '__main__':
-    df = load_tcx_data(sys.argv[1])
+    df = load_activity_data(sys.argv[1])
     print(df.describe())
 
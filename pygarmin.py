@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+'''
+Command line entry point for the pygarmin analysis tools.
+
+Usage: python pygarmin.py <command> [options] ...
+
+Every command imports the modules it needs when it runs, so pandas,
+matplotlib and cartopy are only loaded by the commands that use them. The
+stats of a cached activity, for instance, never import matplotlib.
+'''
+import sys
+import argparse
+
+
+COMPACT_HELP = 'use compact dtypes (int16 heart rate and cadence, float32)'
+
+
+def use_agg():
+    '''Select the non-interactive matplotlib backend before any plotting.'''
+    import matplotlib
+    matplotlib.use('agg')
+
+
+def cmd_stats(args):
+    import parse_tcx
+    for filename in args.files:
+        df = parse_tcx.get_activity_data(filename, args.cache_dir,
+                                         args.compact)
+        if args.html:
+            df.describe().to_html(filename[:-4] + '-statistics.html')
+        else:
+            print(filename)
+            print(df.describe())
+
+
+def cmd_minimal(args):
+    use_agg()
+    import minimalreport
+    for filename in args.files:
+        minimalreport.main(filename)
+
+
+def cmd_summary(args):
+    use_agg()
+    import activity_summary
+    for filename in args.files:
+        activity_summary.main(filename)
+
+
+def cmd_pdf(args):
+    use_agg()
+    import activity_summary_pdf
+    for filename in args.files:
+        activity_summary_pdf.main(filename, maps=not args.no_maps)
+
+
+def cmd_map(args):
+    use_agg()
+    import activitymap
+    for filename in args.files:
+        activitymap.main(filename)
+
+
+def cmd_batch(args):
+    import batch_report
+    kinds = args.kinds.split(',')
+    for kind in kinds:
+        if kind not in batch_report.KINDS:
+            raise SystemExit('unknown report kind: {0}'.format(kind))
+    failed = batch_report.render_files(
+        batch_report.find_tcx_files(args.paths), kinds, args.processes,
+        not args.no_maps)
+    return 1 if failed else 0
+
+
+def cmd_ingest(args):
+    import archive
+    import ingest
+    import parse_tcx
+    files = archive.expand(args.files)
+    if args.store:
+        # Members already in the store are skipped by their cache key
+        import activity_store
+        store = activity_store.ActivityStore(args.store)
+        ids = ingest.update_store(store, files, args.cache_dir,
+                                  args.processes, compact=args.compact)
+        known = store.activity_ids()
+        cache = parse_tcx.get_cache(args.cache_dir)
+        skipped = set(f for f, key in zip(files, ids) if key not in known and
+                      key is not None and ingest.is_unsupported(cache, key))
+        failed = [f for f, key in zip(files, ids)
+                  if key not in known and f not in skipped]
+        print('{0} activities in store, {1} skipped, {2} failed'.format(
+            len(files) - len(skipped) - len(failed), len(skipped),
+            len(failed)))
+        return 1 if failed else 0
+    results = ingest.ingest_files(files, args.cache_dir, args.processes,
+                                  columns=[], compact=args.compact)
+    skipped = [r.filename for r in results if r.skipped]
+    failed = [r.filename for r in results if not r.ok]
+    print('{0} files ingested, {1} skipped, {2} failed'.format(
+        len(results) - len(skipped) - len(failed), len(skipped),
+        len(failed)))
+    return 1 if failed else 0
+
+
+def cmd_totals(args):
+    use_agg()
+    if args.sport == 'run':
+        import run_totals as script
+    else:
+        import bike_totals as script
+    script.main(args.directory, args.outpath, args.datefilt, args.processes,
+                args.scatter_size, args.compact)
+
+
+def cmd_meanmax(args):
+    import numpy as np
+    import meanmax
+    best = None
+    for filename in args.files:
+        curves = meanmax.get_activity_curves(filename, args.cache_dir)
+        best = curves if best is None else np.fmax(best, curves)
+    print(best)
+
+
+def cmd_prefetch(args):
+    import tiles
+    import activity_store
+    store = activity_store.ActivityStore(args.store)
+    zoom = tiles.MAP_ZOOM if args.zoom is None else args.zoom
+    n = tiles.prefetch(tiles.get_tile_reader(args.tiles),
+                       tiles.store_extents(store), zoom)
+    print('{0} tiles prefetched'.format(n))
+
+
+def cmd_area(args):
+    import spatial
+    import activity_store
+    index = spatial.get_index(activity_store.ActivityStore(args.store))
+    if args.radius is not None:
+        if len(args.coords) != 2:
+            raise SystemExit('--radius takes a single lat lon position')
+        result = index.near(args.coords[0], args.coords[1], args.radius)
+    elif len(args.coords) == 4:
+        result = index.bbox(*args.coords)
+    else:
+        raise SystemExit('give lat_min lat_max lon_min lon_max, '
+                         'or lat lon with --radius')
+    print(result.to_string())
+
+
+def cmd_heatmap(args):
+    use_agg()
+    import heatmap
+    import activity_store
+    store = activity_store.ActivityStore(args.store)
+    start, end = activity_store.date_range(args.date or '')
+    sport = {'run': 'Running', 'bike': 'Biking', None: None}[args.sport]
+    result = heatmap.archive_heatmap(store, args.extent,
+                                     (args.bins, args.bins), sport, start, end)
+    fig = heatmap.heatmap_figure(result, basemap=not args.no_basemap)
+    fig.savefig(args.output, dpi=150)
+
+
+def cmd_load(args):
+    import activity_store
+    import parse_tcx
+    import trainingload
+    store = activity_store.ActivityStore(args.store)
+    settings = trainingload.LoadSettings(args.hrrest, args.hrmax, args.lt)
+    sport = {'run': 'Running', 'bike': 'Biking', None: None}[args.sport]
+    result = trainingload.get_training_load(
+        store, parse_tcx.get_cache(args.cache_dir), settings, sport,
+        args.score)
+    print(result.tail(args.days).to_string(float_format='{0:.1f}'.format))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='record the time of each pipeline stage to a '
+                             '.json or .csv trace and print a summary')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also record the peak memory of each stage')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    def command(name, func, help):
+        sub = commands.add_parser(name, help=help, description=help)
+        sub.set_defaults(func=func)
+        return sub
+
+    def add_files(sub, cache=False):
+        sub.add_argument('files', nargs='+', help='tcx or FIT files')
+        if cache:
+            sub.add_argument('--cache-dir', default=None,
+                             help='activity cache directory (default: '
+                                  'PYGARMIN_CACHE_DIR or ~/.cache/pygarmin)')
+
+    sub = command('stats', cmd_stats, 'basic statistics of activities')
+    add_files(sub, cache=True)
+    sub.add_argument('--html', action='store_true',
+                     help='write <file>-statistics.html instead of printing')
+    sub.add_argument('--compact', action='store_true', help=COMPACT_HELP)
+    add_files(command('minimal', cmd_minimal, 'minimal heart rate report'))
+    add_files(command('summary', cmd_summary, 'activity summary figure'))
+    sub = command('pdf', cmd_pdf, 'multi-page PDF activity report')
+    add_files(sub)
+    sub.add_argument('--no-maps', action='store_true',
+                     help='leave out the map page (no cartopy needed)')
+    add_files(command('map', cmd_map, 'map of activity positions'))
+
+    sub = command('batch', cmd_batch, 'render reports in parallel')
+    sub.add_argument('paths', nargs='+',
+                     help='tcx or FIT files, or directories of them')
+    sub.add_argument('-j', '--processes', type=int, default=None,
+                     help='number of worker processes (default: CPUs)')
+    sub.add_argument('-k', '--kinds', default='minimal,summary',
+                     help='comma separated reports to render '
+                          '(default: minimal,summary)')
+    sub.add_argument('--no-maps', action='store_true',
+                     help='leave the map page out of pdf reports (no '
+                          'cartopy needed)')
+
+    sub = command('ingest', cmd_ingest, 'parse tcx files into the cache')
+    sub.add_argument('cache_dir', help='activity cache directory')
+    sub.add_argument('files', nargs='+',
+                     help='tcx or FIT files, gzipped or in zip archives')
+    sub.add_argument('-j', '--processes', type=int, default=None,
+                     help='number of worker processes (default: CPUs)')
+    sub.add_argument('--compact', action='store_true', help=COMPACT_HELP)
+    sub.add_argument('--store', default=None,
+                     help='also add new activities to this activity store')
+
+    sub = command('totals', cmd_totals, 'totals of all run or bike data')
+    sub.add_argument('sport', choices=['run', 'bike'])
+    sub.add_argument('directory', help='directory of tcx files')
+    sub.add_argument('outpath', help='directory of the store and figure')
+    sub.add_argument('datefilt', help='date prefix, YYYY[-MM[-DD]]')
+    sub.add_argument('-j', '--processes', type=int, default=None,
+                     help='number of worker processes (default: CPUs)')
+    sub.add_argument('--scatter-size', type=int, default=0,
+                     help='points in the slope/speed scatter plot')
+    sub.add_argument('--compact', action='store_true',
+                     help=COMPACT_HELP + ' (in a new store)')
+
+    add_files(command('meanmax', cmd_meanmax, 'best effort curves'),
+              cache=True)
+
+    sub = command('area', cmd_area, 'activities through an area')
+    sub.add_argument('store', help='consolidated activity store (.h5)')
+    sub.add_argument('coords', nargs='+', type=float,
+                     help='lat_min lat_max lon_min lon_max, or lat lon')
+    sub.add_argument('-r', '--radius', type=float, default=None,
+                     help='radius in meters around lat lon')
+
+    sub = command('heatmap', cmd_heatmap, 'heatmap of all stored positions')
+    sub.add_argument('store', help='consolidated activity store (.h5)')
+    sub.add_argument('output', help='image file to write')
+    sub.add_argument('--sport', choices=['run', 'bike'], default=None)
+    sub.add_argument('--date', default=None,
+                     help='only activities of a YYYY[-MM[-DD]] period')
+    sub.add_argument('--extent', type=float, nargs=4, default=None,
+                     metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'),
+                     help='map extent (default: all positions)')
+    sub.add_argument('--bins', type=int, default=1000,
+                     help='grid cells along each side (default: 1000)')
+    sub.add_argument('--no-basemap', action='store_true',
+                     help='leave out the map tiles (no cartopy needed)')
+
+    sub = command('load', cmd_load, 'training load, fitness and fatigue')
+    sub.add_argument('store', help='consolidated activity store (.h5)')
+    sub.add_argument('hrrest', type=float, help='resting heart rate')
+    sub.add_argument('hrmax', type=float, help='maximum heart rate')
+    sub.add_argument('--lt', type=float, default=None,
+                     help='lactate threshold heart rate, for its zones '
+                          '(default: Karvonen zones)')
+    sub.add_argument('--sport', choices=['run', 'bike'], default=None)
+    sub.add_argument('--score', choices=['trimp', 'zone_trimp'],
+                     default='trimp', help='load score (default: trimp)')
+    sub.add_argument('--days', type=int, default=14,
+                     help='number of days to print (default: 14)')
+    sub.add_argument('--cache-dir', default=None,
+                     help='activity cache directory of the scores')
+
+    sub = command('prefetch', cmd_prefetch, 'fetch map tiles of a store')
+    sub.add_argument('store', help='consolidated activity store (.h5)')
+    sub.add_argument('--zoom', type=int, default=None,
+                     help='tile zoom level (default: map zoom level)')
+    sub.add_argument('--tiles', required=True,
+                     help='tile URL template of a server that allows bulk '
+                     'downloads (not OpenStreetMap)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.trace is None:
+        return args.func(args)
+
+    import instrument
+    instrument.enable(args.trace_memory)
+    try:
+        return args.func(args)
+    finally:
+        records = instrument.disable()
+        instrument.write_trace(args.trace, records)
+        instrument.print_summary(records)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+'''
+Spatial index of the activities in a consolidated activity store.
+
+Every activity is thinned to one position per SPACING meters along its
+track, and the points are kept sorted by the cell of a regular
+latitude/longitude grid. Bounding box and radius queries only look at the
+cells overlapping the query, and return the matching activities with the
+time range they spent inside it.
+
+The index is saved next to the store and updated with the activities that
+were added to the store since, see get_index.
+
+Usage: python spatial.py <activities.h5> bbox lat_min lat_max lon_min lon_max
+       python spatial.py <activities.h5> near lat lon radius_m
+'''
+import os
+import sys
+import numpy as np
+import pandas as pd
+import activity_cache
+
+
+#: Distance in meters between the indexed points of a track.
+SPACING = 50.0
+
+#: Size of the grid cells in degrees.
+CELL = 0.01
+
+EARTH_RADIUS = 6371000.0
+
+NAME = 'SpatialIndex'
+
+COLUMNS = ['Cell', 'ActivityId', 'Time', 'Latitude', 'Longitude']
+
+# Cells per row of the grid, cell numbers grow along longitude first
+_NLON = int(round(360/CELL))
+
+
+def cell_index(lat, lon):
+    '''Grid cell numbers of positions.'''
+    i = np.floor((np.asarray(lat) + 90)/CELL).astype(np.int64)
+    j = np.floor((np.asarray(lon) + 180)/CELL).astype(np.int64)
+    return i*_NLON + j
+
+
+def thin_track(df, spacing=SPACING):
+    '''Rows of df at about spacing meters apart along the track.
+
+    Rows without a position are left out.
+    '''
+    lat = df['Latitude'].values
+    lon = df['Longitude'].values
+    valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    if len(valid) == 0:
+        return df.iloc[valid]
+    if 'DistanceMeters' in df.columns:
+        distance = df['DistanceMeters'].values[valid]
+        distance = np.where(np.isfinite(distance), distance, 0)
+        distance = np.maximum.accumulate(distance)
+    else:
+        distance = np.concatenate([[0], np.cumsum(haversine(
+            lat[valid[:-1]], lon[valid[:-1]], lat[valid[1:]],
+            lon[valid[1:]]))])
+    # First point of every spacing interval, and the last point
+    step = np.floor(distance/spacing)
+    keep = np.concatenate([[True], step[1:] != step[:-1]])
+    keep[-1] = True
+    return df.iloc[valid[keep]]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''Great circle distance in meters.'''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float))
+                              for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1)/2)**2 +
+         np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2)
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex(object):
+    '''Thinned activity positions sorted by grid cell.'''
+
+    def __init__(self, points=None):
+        if points is None:
+            points = pd.DataFrame({'Cell': np.zeros(0, dtype=np.int64),
+                                   'ActivityId': np.zeros(0, dtype=object),
+                                   'Time': pd.to_datetime([]),
+                                   'Latitude': np.zeros(0),
+                                   'Longitude': np.zeros(0)},
+                                  columns=COLUMNS)
+        self._frames = [points]
+        self._points = None
+
+    @property
+    def points(self):
+        '''All indexed points, sorted by cell.'''
+        if self._points is None:
+            points = pd.concat(self._frames, ignore_index=True)
+            points = points.sort_values('Cell', kind='stable')
+            self._points = points.reset_index(drop=True)
+            self._frames = [self._points]
+            self._cells = self._points['Cell'].values
+        return self._points
+
+    def activity_ids(self):
+        return set(self.points['ActivityId'])
+
+    def add(self, activity_id, df):
+        '''Index an activity with Time, Latitude and Longitude columns.'''
+        track = thin_track(df)
+        lat = track['Latitude'].values.astype(float)
+        lon = track['Longitude'].values.astype(float)
+        self._frames.append(pd.DataFrame(
+            {'Cell': cell_index(lat, lon), 'ActivityId': activity_id,
+             'Time': track['Time'].values, 'Latitude': lat,
+             'Longitude': lon}, columns=COLUMNS))
+        self._points = None
+
+    def update(self, store):
+        '''Index the activities of store that are not indexed yet.
+
+        Returns the number of activities added.
+        '''
+        missing = store.activity_ids() - self.activity_ids()
+        n = 0
+        if missing:
+            for activity_id, df in store.iter_activities(
+                    ids=missing, columns=['Time', 'DistanceMeters',
+                                          'Latitude', 'Longitude']):
+                self.add(activity_id, df)
+                n += 1
+        return n
+
+    def _select(self, lat_min, lat_max, lon_min, lon_max):
+        # Points in the cells overlapping the box, one cell row at a time
+        points = self.points
+        i0, j0 = divmod(cell_index(lat_min, lon_min), _NLON)
+        i1, j1 = divmod(cell_index(lat_max, lon_max), _NLON)
+        rows = np.arange(i0, i1 + 1)*_NLON
+        starts = np.searchsorted(self._cells, rows + j0, side='left')
+        ends = np.searchsorted(self._cells, rows + j1, side='right')
+        index = np.concatenate([np.arange(s, e) for s, e in
+                                zip(starts, ends)] + [np.zeros(0, int)])
+        return points.iloc[index]
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max):
+        '''Activities with points inside a latitude/longitude box.
+
+        Returns a frame of ActivityId, Start and End of the time spent in
+        the box, and the number of matching points.
+        '''
+        points = self._select(lat_min, lat_max, lon_min, lon_max)
+        lat = points['Latitude'].values
+        lon = points['Longitude'].values
+        inside = ((lat >= lat_min) & (lat <= lat_max) &
+                  (lon >= lon_min) & (lon <= lon_max))
+        return matches(points[inside])
+
+    def near(self, lat, lon, radius):
+        '''Activities passing within radius meters of a position.'''
+        dlat = np.degrees(radius/EARTH_RADIUS)
+        dlon = dlat/max(np.cos(np.radians(lat)), 1e-6)
+        points = self._select(lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        inside = haversine(lat, lon, points['Latitude'].values,
+                           points['Longitude'].values) <= radius
+        return matches(points[inside])
+
+    @classmethod
+    def load(cls, path):
+        '''Saved index at path, or an empty index if there is none.'''
+        if not os.path.exists(path):
+            return cls()
+        return cls(pd.read_hdf(path, NAME))
+
+    def save(self, path):
+        points = self.points
+        activity_cache.atomic_write(
+            path, lambda tmp: points.to_hdf(tmp, key=NAME, mode='w'))
+
+
+def matches(points):
+    '''Per-activity time range of matching points.'''
+    grouped = points.groupby('ActivityId', sort=False)['Time']
+    result = pd.DataFrame({'Start': grouped.min(), 'End': grouped.max(),
+                           'NPoints': grouped.size()})
+    result.index.name = 'ActivityId'
+    return result.sort_values('Start').reset_index()
+
+
+def index_path(store):
+    return os.path.splitext(store.path)[0] + '-spatial.h5'
+
+
+def get_index(store, path=None):
+    '''Spatial index of store, updated and saved if activities were added.'''
+    if path is None:
+        path = index_path(store)
+    index = SpatialIndex.load(path)
+    if index.update(store):
+        index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    import time
+    import activity_store
+    store = activity_store.ActivityStore(sys.argv[1])
+    index = get_index(store)
+    args = [float(a) for a in sys.argv[3:]]
+    start = time.perf_counter()
+    if sys.argv[2] == 'bbox':
+        result = index.bbox(*args)
+    else:
+        result = index.near(*args)
+    elapsed = time.perf_counter() - start
+    print(result.to_string())
+    print('{0} activities in {1:.1f} ms'.format(len(result), 1000*elapsed))
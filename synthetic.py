@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic Garmin tcx files for benchmarks and experiments.
+
+Activities follow a smooth random course with plausible speed, heart rate,
+cadence and altitude. The layout is the one written by Garmin Connect and
+read by parse_tcx: running cadence per foot in the TPX extension, cycling
+cadence in the Cadence element.
+
+Usage: python synthetic.py directory [n_files] [npoints]
+'''
+import os
+import sys
+import datetime
+import numpy as np
+
+
+TCX_NS = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
+EXT_NS = 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'
+
+#: Typical (speed km/h, heart rate bpm, cadence) of the generated sports.
+SPORTS = {'Running': (11.0, 150.0, 85.0),
+          'Biking': (25.0, 135.0, 88.0)}
+
+#: File name suffixes matched by the run and bike totals scripts.
+SUFFIXES = {'Running': 'Running', 'Biking': 'Cycling_Cycling'}
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
+<TrainingCenterDatabase xmlns="{0}" xmlns:ns3="{1}">
+  <Activities>
+    <Activity Sport="{2}">
+      <Id>{3}</Id>
+      <Lap StartTime="{3}">
+        <Track>
+'''
+
+FOOTER = '''        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+
+def smooth_noise(rng, npoints, scale, length=60):
+    '''Random signal of about scale amplitude, varying over length points.'''
+    noise = rng.standard_normal(npoints + length)
+    kernel = np.hanning(length)
+    kernel /= np.sqrt((kernel**2).sum())
+    return scale*np.convolve(noise, kernel, mode='valid')[:npoints]
+
+
+def activity_arrays(sport='Running', npoints=3600, interval=1.0, seed=0):
+    '''Column arrays of a synthetic activity of npoints samples.'''
+    rng = np.random.RandomState(seed)
+    speed0, hr0, cadence0 = SPORTS[sport]
+    seconds = interval*np.arange(npoints)
+    speed = np.clip(speed0 + smooth_noise(rng, npoints, 0.15*speed0), 1, None)
+    distance = np.concatenate([[0], np.cumsum(speed[1:]/3.6*interval)])
+    altitude = 100 + np.cumsum(smooth_noise(rng, npoints, 0.2*interval))
+    hr = np.round(hr0 + 0.5*(speed - speed0) + smooth_noise(rng, npoints, 8))
+    cadence = np.round(cadence0 + smooth_noise(rng, npoints, 3))
+    # Follow the course with a slowly turning heading
+    heading = np.cumsum(smooth_noise(rng, npoints, 0.05))
+    step = np.diff(distance, prepend=0)
+    lat = 60 + np.cumsum(step*np.cos(heading))/111195.0
+    lon = 10 + np.cumsum(step*np.sin(heading))/(111195.0*np.cos(np.radians(60)))
+    return dict(SecondsElapsed=seconds, Speed=speed, DistanceMeters=distance,
+                AltitudeMeters=altitude, HeartRateBpm=hr, Cadence=cadence,
+                Latitude=lat, Longitude=lon)
+
+
+def trackpoint_template(sport, heartrate=True, cadence=True, position=True):
+    '''Format string of one Trackpoint element.'''
+    parts = ['          <Trackpoint>\n'
+             '            <Time>{Time}</Time>\n']
+    if position:
+        parts.append('            <Position>\n'
+                     '              <LatitudeDegrees>{Latitude:.7f}'
+                     '</LatitudeDegrees>\n'
+                     '              <LongitudeDegrees>{Longitude:.7f}'
+                     '</LongitudeDegrees>\n'
+                     '            </Position>\n')
+    parts.append('            <AltitudeMeters>{AltitudeMeters:.1f}'
+                 '</AltitudeMeters>\n'
+                 '            <DistanceMeters>{DistanceMeters:.2f}'
+                 '</DistanceMeters>\n')
+    if heartrate:
+        parts.append('            <HeartRateBpm>\n'
+                     '              <Value>{HeartRateBpm:.0f}</Value>\n'
+                     '            </HeartRateBpm>\n')
+    if cadence and sport != 'Running':
+        parts.append('            <Cadence>{Cadence:.0f}</Cadence>\n')
+    parts.append('            <Extensions>\n'
+                 '              <ns3:TPX>\n'
+                 '                <ns3:Speed>{Speed:.3f}</ns3:Speed>\n')
+    if cadence and sport == 'Running':
+        parts.append('                <ns3:RunCadence>{Cadence:.0f}'
+                     '</ns3:RunCadence>\n')
+    parts.append('              </ns3:TPX>\n'
+                 '            </Extensions>\n'
+                 '          </Trackpoint>\n')
+    return ''.join(parts)
+
+
+def write_tcx(filename, sport='Running', npoints=3600, interval=1.0,
+              heartrate=True, cadence=True, position=True, seed=0,
+              start=datetime.datetime(2015, 1, 1, 12)):
+    '''Write a synthetic activity of npoints samples, interval seconds apart.
+
+    heartrate, cadence and position select the recorded fields.
+    '''
+    arrays = activity_arrays(sport, npoints, interval, seed)
+    times = [(start + datetime.timedelta(seconds=float(s))).strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z') for s in arrays['SecondsElapsed']]
+    template = trackpoint_template(sport, heartrate, cadence, position)
+    names = ['DistanceMeters', 'AltitudeMeters', 'HeartRateBpm', 'Cadence',
+             'Latitude', 'Longitude']
+    with open(filename, 'w') as f:
+        f.write(HEADER.format(TCX_NS, EXT_NS, sport, times[0]))
+        for i, time in enumerate(times):
+            values = dict((name, arrays[name][i]) for name in names)
+            # The TPX speed is in m/s
+            values['Speed'] = arrays['Speed'][i]/3.6
+            f.write(template.format(Time=time, **values))
+        f.write(FOOTER)
+    return filename
+
+
+def write_fit(filename, sport='Running', npoints=3600, interval=1.0,
+              heartrate=True, cadence=True, position=True, seed=0,
+              start=datetime.datetime(2015, 1, 1, 12), compressed=False,
+              events=False):
+    '''Write the activity of write_tcx with the same arguments as FIT file.
+
+    Times are rounded to whole seconds, as in FIT record messages. With
+    compressed=True only the first record has a timestamp field, the others
+    use compressed timestamp headers, so interval must be below 32 s. With
+    events=True as well, every compressed record follows a timer event
+    message with a full timestamp 1 s before it, and interval can be longer.
+    '''
+    import struct
+    import fit
+    arrays = activity_arrays(sport, npoints, interval, seed)
+    epoch = (start - datetime.datetime(1989, 12, 31)).total_seconds()
+    timestamp = np.round(epoch + arrays['SecondsElapsed']).astype('<u4')
+    semicircles = 2**31/180.0
+
+    # (field number, numpy type, base type, values)
+    fields = [(253, '<u4', 0x86, timestamp)]
+    if position:
+        fields += [(0, '<i4', 0x85, np.round(arrays['Latitude']*semicircles)),
+                   (1, '<i4', 0x85, np.round(arrays['Longitude']*semicircles))]
+    fields += [(2, '<u2', 0x84, np.round((arrays['AltitudeMeters'] + 500)*5))]
+    if heartrate:
+        fields += [(3, 'u1', 0x02, arrays['HeartRateBpm'])]
+    if cadence:
+        fields += [(4, 'u1', 0x02, arrays['Cadence'])]
+    fields += [(5, '<u4', 0x86, np.round(arrays['DistanceMeters']*100)),
+               (6, '<u2', 0x84, np.round(arrays['Speed']/3.6*1000))]
+
+    def definition(local, global_number, defs):
+        out = struct.pack('<BBBHB', 0x40 | local, 0, 0, global_number,
+                          len(defs))
+        for number, fmt, base_type in defs:
+            out += struct.pack('<BBB', number, np.dtype(fmt).itemsize,
+                               base_type)
+        return out
+
+    sport_number = dict((v, k) for k, v in fit.SPORTS.items())[sport]
+    messages = [definition(0, 0, [(0, 'u1', 0x00), (4, '<u4', 0x86)]),
+                struct.pack('<BBI', 0, 4, timestamp[0]),
+                definition(1, fit.SPORT, [(0, 'u1', 0x00)]),
+                struct.pack('<BB', 1, sport_number),
+                definition(2, fit.RECORD, [(number, fmt, base_type)
+                                           for number, fmt, base_type, values
+                                           in fields])]
+    def record_messages(header, fields, index):
+        records = np.zeros(len(header), dtype=[('header', 'u1')] +
+                           [('f{0}'.format(number), fmt)
+                            for number, fmt, base_type, values in fields])
+        records['header'] = header
+        for number, fmt, base_type, values in fields:
+            records['f{0}'.format(number)] = values[index]
+        return records.tobytes()
+
+    if compressed:
+        # Local type 3 without the timestamp field, for compressed headers
+        messages.append(record_messages([2], fields, slice(0, 1)))
+        messages.append(definition(3, fit.RECORD,
+                                   [(number, fmt, base_type)
+                                    for number, fmt, base_type, values
+                                    in fields[1:]]))
+        records = record_messages(0x80 | (3 << 5) | (timestamp[1:] & 0x1F),
+                                  fields[1:], slice(1, None))
+        if events:
+            # Timer start events (event 0, type 0) of local type 4
+            messages.append(definition(4, fit.EVENT, [(253, '<u4', 0x86),
+                                                  (0, 'u1', 0x00),
+                                                  (1, 'u1', 0x00)]))
+            size = len(records)//(npoints - 1)
+            for i in range(npoints - 1):
+                messages.append(struct.pack('<BIBB', 4, timestamp[i + 1] - 1,
+                                            0, 0))
+                messages.append(records[i*size:(i + 1)*size])
+        else:
+            messages.append(records)
+    else:
+        messages.append(record_messages(np.full(npoints, 2), fields,
+                                        slice(None)))
+    data = b''.join(messages)
+
+    header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(data), b'.FIT')
+    header += struct.pack('<H', fit.crc(header))
+    with open(filename, 'wb') as f:
+        f.write(header)
+        f.write(data)
+        f.write(struct.pack('<H', fit.crc(data, fit.crc(header))))
+    return filename
+
+
+def tcx_filename(directory, sport, date, name='Synthetic'):
+    '''File name in the Garmin Connect export style used by the scripts.'''
+    return os.path.join(directory, '{0}_{1}_{2}.tcx'.format(
+        date.strftime('%Y-%m-%d'), name, SUFFIXES[sport]))
+
+
+def write_archive(directory, nfiles=10, npoints=3600, interval=1.0, seed=0,
+                  start=datetime.datetime(2015, 1, 1, 12)):
+    '''Write nfiles activities on consecutive days, alternating sports.
+
+    Returns the list of file names.
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    for i in range(nfiles):
+        sport = 'Running' if i % 2 == 0 else 'Biking'
+        date = start + datetime.timedelta(days=i)
+        filename = tcx_filename(directory, sport, date,
+                                'Synthetic{0:04d}'.format(i))
+        filenames.append(write_tcx(filename, sport, npoints, interval,
+                                   seed=seed + i, start=date))
+    return filenames
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1]
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    npoints = int(sys.argv[3]) if len(sys.argv) > 3 else 3600
+    filenames = write_archive(directory, nfiles, npoints)
+    print('{0} files written to {1}'.format(len(filenames), directory))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+'''
+Map tile sources for activity maps, with a persistent on-disk tile cache.
+
+Tiles are read from a tile server, a local {z}/{x}/{y}.png directory or an
+MBTiles file. Server tiles are kept in an LRU cache on disk, so maps render
+without network once the tiles of an area have been fetched, and tiles are
+shared between activities. The source is chosen by get_tile_reader, from
+the PYGARMIN_TILES environment variable. Drawing the tiles on a cartopy map
+is done by activitymap.CachedTiler, so this module does not need cartopy.
+
+Usage: python tiles.py prefetch <activities.h5> <tiles> [zoom]
+fetches the tiles of all activities in a consolidated activity store from
+tiles, a tile server URL template that allows bulk downloads.
+'''
+import os
+import sys
+import math
+import time
+import sqlite3
+import urllib.request
+import numpy as np
+import activity_cache
+
+
+OSM_URL = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'
+USER_AGENT = 'pygarmin (+https://github.com/nepstad/pygarmin)'
+
+#: Default size cap of the on-disk tile cache, in bytes.
+MAX_CACHE_BYTES = 512*1024**2
+
+#: Zoom level of activity maps.
+MAP_ZOOM = 15
+
+#: Minimum seconds between two requests to a tile server.
+REQUEST_DELAY = 1.0
+
+
+class HTTPSource(object):
+    '''Tiles fetched from a tile server URL template.
+
+    Requests are at least delay seconds apart, tile servers do not allow
+    fetching tiles as fast as possible.
+    '''
+
+    def __init__(self, url=OSM_URL, user_agent=USER_AGENT, timeout=30,
+                 delay=REQUEST_DELAY):
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.delay = delay
+        self._last_request = None
+
+    def read(self, tile):
+        x, y, z = tile
+        if self._last_request is not None:
+            wait = self._last_request + self.delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        self._last_request = time.time()
+        request = urllib.request.Request(self.url.format(x=x, y=y, z=z),
+                                         headers={'User-Agent':
+                                                  self.user_agent})
+        with urllib.request.urlopen(request, timeout=self.timeout) as f:
+            return f.read()
+
+
+class DirectorySource(object):
+    '''Tiles read from a local {z}/{x}/{y}.<ext> directory tree.'''
+
+    def __init__(self, directory, ext='png'):
+        self.directory = directory
+        self.ext = ext
+
+    def path(self, tile):
+        x, y, z = tile
+        return os.path.join(self.directory, str(z), str(x),
+                            '{0}.{1}'.format(y, self.ext))
+
+    def read(self, tile):
+        path = self.path(tile)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class MBTilesSource(object):
+    '''Tiles read from an MBTiles (SQLite) file.'''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+    def read(self, tile):
+        x, y, z = tile
+        # MBTiles rows count from the south (TMS scheme)
+        row = self.connection.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND '
+            'tile_column=? AND tile_row=?', (z, x, 2**z - 1 - y)).fetchone()
+        return None if row is None else bytes(row[0])
+
+
+class TileCache(DirectorySource):
+    '''Size-capped on-disk tile cache with least recently used eviction.'''
+
+    def __init__(self, directory, max_bytes=MAX_CACHE_BYTES, ext='png'):
+        DirectorySource.__init__(self, directory, ext)
+        self.max_bytes = max_bytes
+        self._size = None
+
+    @property
+    def size(self):
+        '''Bytes in the cache, only counted when first needed, so reading
+        cached tiles does not walk the whole cache.'''
+        if self._size is None:
+            self._size = sum(size for path, size, mtime in self._entries())
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        self._size = size
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                yield path, st.st_size, st.st_mtime
+
+    def read(self, tile):
+        data = DirectorySource.read(self, tile)
+        if data is not None:
+            # The modification time doubles as last access time
+            os.utime(self.path(tile), None)
+        return data
+
+    def write(self, tile, data):
+        path = self.path(tile)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                f.write(data)
+        activity_cache.atomic_write(path, write)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self, fraction=0.9):
+        '''Remove least recently used tiles down to fraction of the cap.'''
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self.size <= fraction*self.max_bytes:
+                break
+            os.remove(path)
+            self.size -= size
+
+
+class TileReader(object):
+    '''Tiles read from a source through an optional TileCache.'''
+
+    def __init__(self, source, cache=None):
+        self.source = source
+        self.cache = cache
+
+    def read_tile(self, tile):
+        '''Raw image data of a tile, or None if it is not available.'''
+        data = None
+        if self.cache is not None:
+            data = self.cache.read(tile)
+        if data is None:
+            data = self.source.read(tile)
+            if data is not None and self.cache is not None:
+                self.cache.write(tile, data)
+        return data
+
+
+def get_tile_reader(tiles=None, cache_dir=None):
+    '''Tile reader for activity maps.
+
+    tiles (default: PYGARMIN_TILES, else OpenStreetMap) is a URL template,
+    a tile directory or an .mbtiles file. Tiles from a URL are cached in
+    the tiles directory of the activity cache.
+    '''
+    if tiles is None:
+        tiles = os.environ.get('PYGARMIN_TILES', OSM_URL)
+    if tiles.endswith('.mbtiles'):
+        return TileReader(MBTilesSource(tiles))
+    if os.path.isdir(tiles):
+        return TileReader(DirectorySource(tiles))
+    cache = TileCache(os.path.join(activity_cache.get_cache_dir(cache_dir),
+                                   'tiles'))
+    return TileReader(HTTPSource(tiles), cache)
+
+
+def tile_range(lon_min, lon_max, lat_min, lat_max, zoom):
+    '''All (x, y, z) tiles covering a longitude/latitude box.'''
+    def tile_xy(lon, lat):
+        n = 2**zoom
+        x = int((lon + 180)/360*n)
+        lat = math.radians(lat)
+        y = int((1 - math.asinh(math.tan(lat))/math.pi)/2*n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+    x0, y0 = tile_xy(lon_min, lat_max)
+    x1, y1 = tile_xy(lon_max, lat_min)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y, zoom
+
+
+def map_extent(lon, lat, margin=0.1):
+    '''Map extent around positions, with a margin relative to their span.'''
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    dlon = margin*(np.nanmax(lon) - np.nanmin(lon))
+    dlat = margin*(np.nanmax(lat) - np.nanmin(lat))
+    return (np.nanmin(lon) - dlon, np.nanmax(lon) + dlon,
+            np.nanmin(lat) - dlat, np.nanmax(lat) + dlat)
+
+
+def zoom_for_extent(extent, tiles_across=6, max_zoom=MAP_ZOOM):
+    '''Zoom level showing a lon_min, lon_max, lat_min, lat_max extent with
+    about tiles_across tiles along its longer side.'''
+    lon_min, lon_max, lat_min, lat_max = extent
+    span = max(lon_max - lon_min,
+               (lat_max - lat_min)/math.cos(math.radians(
+                   (lat_min + lat_max)/2)), 1e-6)
+    zoom = int(math.floor(math.log(tiles_across*360.0/span, 2)))
+    return min(max(zoom, 0), max_zoom)
+
+
+def prefetch(reader, extents, zoom=MAP_ZOOM):
+    '''Warm the tile cache for a list of map extents.
+
+    Returns the number of distinct tiles covered. The OpenStreetMap tile
+    servers do not allow bulk downloads, prefetching from them is refused.
+    '''
+    if isinstance(reader.source, HTTPSource) and \
+            reader.source.url == OSM_URL:
+        raise ValueError('Prefetching from {0} is not allowed by the '
+                         'OpenStreetMap tile usage policy, use another tile '
+                         'server'.format(OSM_URL))
+    tiles = set()
+    for extent in extents:
+        tiles.update(tile_range(*(tuple(extent) + (zoom,))))
+    for i, tile in enumerate(sorted(tiles)):
+        try:
+            reader.read_tile(tile)
+        except IOError as e:
+            print('Failed to fetch tile {0}: {1}'.format(tile, e))
+        if (i + 1) % 100 == 0:
+            print('{0}/{1} tiles'.format(i + 1, len(tiles)))
+    return len(tiles)
+
+
+def store_extents(store):
+    '''Map extents of all activities with positions in an activity store.'''
+    extents = []
+    for activity_id, df in store.iter_activities(
+            columns=['Latitude', 'Longitude']):
+        if np.isfinite(df['Latitude'].values).any():
+            extents.append(map_extent(df['Longitude'], df['Latitude']))
+    return extents
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'prefetch':
+        import activity_store
+        store = activity_store.ActivityStore(sys.argv[2])
+        zoom = int(sys.argv[4]) if len(sys.argv) > 4 else MAP_ZOOM
+        n = prefetch(get_tile_reader(sys.argv[3]), store_extents(store), zoom)
+        print('{0} tiles prefetched'.format(n))
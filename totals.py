@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming aggregation of trackpoint data over many activities.
+
+Each activity is reduced into fixed-bin histograms and running statistics
+as soon as it has been read, so memory use stays constant no matter how many
+activities are summarized. The slope/speed scatter plot is drawn from an
+optional fixed-size reservoir sample of the trackpoints. Heart rate, cadence
+and speed are also binned on the fine grids of the density module, and drawn
+as smoothed densities over the histograms.
+
+All summaries can be merged, so the totals of an archive are computed from
+per-activity summaries cached next to the activity data, see archive_totals.
+'''
+import numpy as np
+import activity_store
+import density
+import instrument
+
+
+#: Version of the cached per-activity summaries, bump it when they change.
+SUMMARY_VERSION = 2
+
+#: Columns with a binned density estimate in the totals.
+DENSITY_COLUMNS = ['HeartRateBpm', 'Cadence', 'Speed']
+
+#: Trackpoint columns needed to compute the totals.
+COLUMNS = ['HeartRateBpm', 'SecondsElapsed', 'AltitudeMeters', 'Slope',
+           'Cadence', 'Speed']
+
+
+class MetricAccumulator(object):
+    '''Fixed-bin histogram and running min/mean/max of a metric.
+
+    As in the totals figures, the statistics only cover positive values.
+    '''
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        self.counts += np.histogram(values, self.bins)[0]
+        positive = values[values > 0]
+        if positive.size:
+            self.n += positive.size
+            self.total += positive.sum()
+            self.min = min(self.min, positive.min())
+            self.max = max(self.max, positive.max())
+
+    def merge(self, other):
+        '''Add the counts and statistics of another accumulator.'''
+        self.counts += other.counts
+        self.n += other.n
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else np.nan
+
+    def to_dict(self):
+        return {'bins': self.bins.tolist(), 'counts': self.counts.tolist(),
+                'n': self.n, 'total': self.total,
+                'min': float(self.min), 'max': float(self.max)}
+
+    @classmethod
+    def from_dict(cls, d):
+        acc = cls(d['bins'])
+        acc.counts[:] = d['counts']
+        acc.n = d['n']
+        acc.total = d['total']
+        acc.min = d['min']
+        acc.max = d['max']
+        return acc
+
+
+class ReservoirSample(object):
+    '''Uniform random sample of at most size rows from a stream of rows.'''
+
+    def __init__(self, size, ncols, seed=None):
+        self.size = size
+        self.data = np.empty((size, ncols))
+        self.seen = 0
+        self.random = np.random.RandomState(seed)
+
+    def add(self, *columns):
+        rows = np.column_stack(columns)
+        # Fill up the reservoir first
+        nfill = max(0, min(self.size - self.seen, len(rows)))
+        self.data[self.seen:self.seen + nfill] = rows[:nfill]
+        rows = rows[nfill:]
+        self.seen += nfill
+        if len(rows) == 0:
+            return
+        # Algorithm R: row i of the stream replaces a random slot with
+        # probability size/(i + 1)
+        seen = self.seen + np.arange(len(rows))
+        slots = (self.random.random_sample(len(rows))*(seen + 1)).astype(int)
+        keep = slots < self.size
+        self.data[slots[keep]] = rows[keep]
+        self.seen += len(rows)
+
+    @property
+    def sample(self):
+        return self.data[:min(self.seen, self.size)]
+
+    def merge(self, other):
+        '''Combine with the sample of another, disjoint stream.'''
+        total = self.seen + other.seen
+        if total <= self.size:
+            self.add(*other.sample.T)
+            return
+        # Each part contributes in proportion to the rows it has seen
+        k = self.random.hypergeometric(self.seen, other.seen, self.size)
+        mine = self.sample[self.random.permutation(len(self.sample))[:k]]
+        theirs = other.sample[
+            self.random.permutation(len(other.sample))[:self.size - k]]
+        self.data = np.concatenate([mine, theirs])
+        self.seen = total
+
+    def to_dict(self):
+        return {'size': self.size, 'seen': self.seen,
+                'data': self.sample.tolist()}
+
+    @classmethod
+    def from_dict(cls, d, seed=None):
+        data = np.asarray(d['data'], dtype=float)
+        sample = cls(d['size'], data.shape[1] if data.ndim == 2 else 3, seed)
+        sample.data[:len(data)] = data
+        sample.seen = d['seen']
+        return sample
+
+
+class Totals(object):
+    '''Totals and trackpoint distributions of a set of activities.
+
+    Trackpoints without heart rate or with speed outside (min_speed,
+    max_speed) are left out of the distributions. scatter_size > 0 keeps a
+    reservoir sample of (slope, speed, heart rate) for a scatter plot.
+    '''
+
+    def __init__(self, min_speed, max_speed, scatter_size=0):
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.metrics = {
+            'HeartRateBpm': MetricAccumulator(np.linspace(50, 200, 70)),
+            'Cadence': MetricAccumulator(np.linspace(50, 200, 60)),
+            'Speed': MetricAccumulator(np.linspace(min_speed, max_speed, 50)),
+            'Slope': MetricAccumulator(np.linspace(-45, 45, 91)),
+        }
+        self.densities = dict(
+            (name, density.BinnedDensity.for_column(name))
+            for name in DENSITY_COLUMNS)
+        self.densities['Speed'] = density.BinnedDensity(
+            min_speed, max_speed, density.GRIDS['Speed'][2])
+        self.scatter = None
+        if scatter_size:
+            self.scatter = ReservoirSample(scatter_size, 3)
+        self.count = 0
+        self.duration = 0.0
+        self.elevation_gain = 0.0
+        self.elevation_loss = 0.0
+
+    def add(self, df):
+        '''Add the trackpoints of a single activity.'''
+        self.count += 1
+        self.duration += df['SecondsElapsed'].max()/3600
+
+        eldiff = np.diff(df['AltitudeMeters'].values)
+        self.elevation_gain += eldiff[eldiff > 0].sum()
+        self.elevation_loss += np.abs(eldiff[eldiff < 0]).sum()
+
+        hr = df['HeartRateBpm'].values
+        speed = df['Speed'].values
+        keep = (hr > 0) & (speed > self.min_speed) & (speed < self.max_speed)
+        for name, acc in self.metrics.items():
+            acc.add(df[name].values[keep])
+        for name, binned in self.densities.items():
+            binned.add(df[name].values[keep])
+        if self.scatter is not None:
+            self.scatter.add(df['Slope'].values[keep], speed[keep], hr[keep])
+
+    def merge(self, other):
+        '''Add the totals of another, disjoint set of activities.'''
+        self.count += other.count
+        self.duration += other.duration
+        self.elevation_gain += other.elevation_gain
+        self.elevation_loss += other.elevation_loss
+        for name, acc in self.metrics.items():
+            acc.merge(other.metrics[name])
+        for name, binned in self.densities.items():
+            binned.merge(other.densities[name])
+        if self.scatter is not None:
+            self.scatter.merge(other.scatter)
+
+    def summary_name(self):
+        '''Cache name of per-activity summaries made with these settings.'''
+        return 'Totals-{0:g}-{1:g}-{2}-v{3}'.format(
+            self.min_speed, self.max_speed,
+            self.scatter.size if self.scatter is not None else 0,
+            SUMMARY_VERSION)
+
+    def to_dict(self):
+        d = {'min_speed': self.min_speed, 'max_speed': self.max_speed,
+             'count': self.count, 'duration': float(self.duration),
+             'elevation_gain': float(self.elevation_gain),
+             'elevation_loss': float(self.elevation_loss),
+             'metrics': dict((name, acc.to_dict())
+                             for name, acc in self.metrics.items()),
+             'densities': dict((name, binned.to_dict())
+                               for name, binned in self.densities.items())}
+        if self.scatter is not None:
+            d['scatter'] = self.scatter.to_dict()
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        totals = cls(d['min_speed'], d['max_speed'])
+        totals.count = d['count']
+        totals.duration = d['duration']
+        totals.elevation_gain = d['elevation_gain']
+        totals.elevation_loss = d['elevation_loss']
+        for name, acc in d['metrics'].items():
+            totals.metrics[name] = MetricAccumulator.from_dict(acc)
+        for name, binned in d['densities'].items():
+            totals.densities[name] = density.BinnedDensity.from_dict(binned)
+        if 'scatter' in d:
+            totals.scatter = ReservoirSample.from_dict(d['scatter'])
+        return totals
+
+
+def period_ids(store, ids, datefilt):
+    '''Ids of the stored activities that started in the datefilt period.
+
+    Activities are kept as they are if datefilt is not a date prefix.
+    '''
+    start, end = activity_store.date_range(datefilt)
+    if start is None:
+        return ids
+    known = set(store.activities(start=start, end=end)['ActivityId'])
+    return [activity_id for activity_id in ids if activity_id in known]
+
+
+def archive_totals(store, cache, ids, sport, min_speed, max_speed,
+                   scatter_size=0):
+    '''Totals of the stored activities ids of a sport.
+
+    Totals are merged from per-activity summaries kept in the activity
+    cache. Only activities without a summary for these settings are read
+    from the store, and their summaries are cached for the next run.
+    '''
+    result = Totals(min_speed, max_speed, scatter_size)
+    name = result.summary_name()
+    known = set(store.activities(sport)['ActivityId'])
+    missing = []
+    for activity_id in ids:
+        if activity_id not in known:
+            continue
+        d = cache.load_key_json(activity_id, name)
+        if d is None:
+            missing.append(activity_id)
+        else:
+            result.merge(Totals.from_dict(d))
+
+    for activity_id, df in store.iter_activities(sport, ids=missing,
+                                                 columns=COLUMNS):
+        part = Totals(min_speed, max_speed, scatter_size)
+        with instrument.stage('aggregate', activity_id):
+            part.add(df)
+        cache.store_key_json(activity_id, name, part.to_dict())
+        result.merge(part)
+    return result
+
+
+def statsbox(acc, ax):
+    textstr = 'Min=%.2f\nMean=%.2f\nMax=%.2f'%(acc.min, acc.mean, acc.max)
+    props = dict(boxstyle='round', alpha=0.5, color='w')
+    ax.text(1.1, 0.5, textstr, transform=ax.transAxes, fontsize=10,
+            verticalalignment='center', bbox=props)
+
+
+def totals_figure(totals, datefilt, panels):
+    '''Plot histograms of the given (column, label, xlim) panels.
+
+    A slope/speed scatter plot is added below them if totals keeps a
+    scatter sample, and a summary text box to the right.
+    '''
+    import matplotlib.pyplot as plt
+    nrows = len(panels) + 1
+    fig, axes = plt.subplots(nrows, 2, figsize=(10, 10))
+
+    for i, (column, label, xlim) in enumerate(panels):
+        acc = totals.metrics[column]
+        axes[i, 0].hist(acc.bins[:-1], bins=acc.bins, weights=acc.counts)
+        if column in totals.densities:
+            # Smoothed density, scaled to the histogram counts
+            binned = totals.densities[column]
+            scale = acc.counts.sum()*np.diff(acc.bins).mean()
+            axes[i, 0].plot(binned.grid, scale*binned.density(), 'k-',
+                            lw=1.5)
+        axes[i, 0].set_xlabel(label)
+        if xlim is not None:
+            axes[i, 0].set_xlim(xlim)
+        statsbox(acc, axes[i, 0])
+
+    ax = axes[nrows - 1, 0]
+    if totals.scatter is not None:
+        slope, speed, hr = totals.scatter.sample.T
+        ax.scatter(slope, speed, c=hr, s=100, vmin=50, vmax=200, marker='.',
+                   alpha=0.1)
+        ax.set_xlabel('Slope')
+        ax.set_ylabel('Speed')
+        ax.set_ylim([totals.min_speed, totals.max_speed])
+        ax.set_xlim([-45, 45])
+    else:
+        ax.set_axis_off()
+
+    for i in range(nrows):
+        axes[i, 1].set_axis_off()
+
+    textstr = 'Summary for: ' + datefilt + '\n\n%0.0f activities totalling %0.2f hrs.\nElevation gain: %0.0f m\nElevation loss: %0.0f m'%(totals.count, totals.duration, totals.elevation_gain, totals.elevation_loss)
+    props = dict(boxstyle='round', alpha=0.5, color='w')
+    axes[0, 1].text(0.3, 0.5, textstr, transform=axes[0, 1].transAxes,
+                    fontsize=12, verticalalignment='center', bbox=props,
+                    fontweight='bold', horizontalalignment='left')
+    return fig
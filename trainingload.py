@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+Training load of the activities in a consolidated activity store.
+
+Every activity gets a heart rate based load score, Banister's TRIMP and a
+zone TRIMP (minutes in each heart rate zone of heartrate.py, weighted by
+zone number). Scores are cached per activity in the activity cache. The
+daily loads of the archive are smoothed into exponentially weighted fitness
+and fatigue curves, their difference being the form.
+
+Each workout is counted once: duplicates found by the fingerprint module
+and the old versions of edited files are left out. The curves are saved
+next to the store. When activities are added or replaced, they are only
+recomputed from the first day whose load changed, see update_series.
+
+Usage: python trainingload.py <activities.h5> <cache_dir> hrrest hrmax [lt]
+'''
+import os
+import sys
+import numpy as np
+import pandas as pd
+import activity_cache
+import fingerprint
+import heartrate
+import parse_tcx
+
+
+#: Time constants in days of the fitness and fatigue curves.
+FITNESS_DAYS = 42
+FATIGUE_DAYS = 7
+
+#: Gaps between trackpoints longer than this many seconds are pauses.
+MAX_DT = 30
+
+#: Load score used for the curves, 'trimp' or 'zone_trimp'.
+SCORE = 'trimp'
+
+#: Version of the cached scores, bump it when they change.
+LOAD_VERSION = 1
+
+NAME = 'TrainingLoad'
+
+COLUMNS = ['Load', 'Fitness', 'Fatigue', 'Form']
+
+
+def banister_trimp(df, hrrest, hrmax, factor=1.92):
+    '''Banister's TRIMP of an activity, factor is 1.67 for women.'''
+    dt = heartrate.sample_durations(df['SecondsElapsed'].values, MAX_DT)
+    hr = np.asarray(df['HeartRateBpm'].values, dtype=float)
+    ratio = np.clip((hr - hrrest)/float(hrmax - hrrest), 0, 1)
+    valid = np.isfinite(ratio)
+    ratio = ratio[valid]
+    return float(np.sum(dt[valid]/60*ratio*0.64*np.exp(factor*ratio)))
+
+
+def zone_trimp(df, zones):
+    '''Minutes in each heart rate zone, weighted 1, 2, ... from the lowest.'''
+    hrseries = pd.Series(np.asarray(df['HeartRateBpm'].values, dtype=float),
+                         index=df['SecondsElapsed'].values)
+    seconds = heartrate.get_time_in_zones(hrseries, zones, MAX_DT)['Seconds']
+    weights = np.arange(1, len(zones) + 1)
+    return float(np.sum(seconds.values.astype(float)/60*weights))
+
+
+class LoadSettings(object):
+    '''Heart rates the load scores are computed with.
+
+    The zones are the lactate threshold zones if lt is given, otherwise the
+    five Karvonen zones.
+    '''
+
+    def __init__(self, hrrest, hrmax, lt=None):
+        self.hrrest = hrrest
+        self.hrmax = hrmax
+        self.lt = lt
+
+    def zones(self):
+        if self.lt is not None:
+            return heartrate.get_zones_lactate_thresh(self.lt, self.hrrest,
+                                                      self.hrmax)
+        return heartrate.get_zones_kavonen_five(self.hrrest, self.hrmax)
+
+    def score_name(self):
+        '''Cache name of activity scores made with these settings.'''
+        return 'Load-{0:g}-{1:g}-{2}-v{3}'.format(
+            self.hrrest, self.hrmax,
+            '{0:g}'.format(self.lt) if self.lt is not None else 'k',
+            LOAD_VERSION)
+
+    def activity_scores(self, df):
+        '''Load scores of the trackpoints of an activity.'''
+        df = parse_tcx.expand(df)
+        return {'trimp': banister_trimp(df, self.hrrest, self.hrmax),
+                'zone_trimp': zone_trimp(df, self.zones())}
+
+
+def activity_loads(store, cache, settings, sport=None):
+    '''Scores of the stored activities, from the activity cache.
+
+    Only activities without cached scores for these settings are read from
+    the store. Duplicates and old versions of edited files are left out,
+    see fingerprint.unique_ids. Returns the store index with trimp and
+    zone_trimp columns.
+    '''
+    index = store.activities(sport)
+    unique = fingerprint.unique_ids(store, list(index['ActivityId']))
+    index = index[index['ActivityId'].isin(unique)]
+    name = settings.score_name()
+    scores = {}
+    missing = []
+    for activity_id in index['ActivityId']:
+        d = cache.load_key_json(activity_id, name)
+        if d is None:
+            missing.append(activity_id)
+        else:
+            scores[activity_id] = d
+
+    for activity_id, df in store.iter_activities(
+            sport, ids=missing, columns=['SecondsElapsed', 'HeartRateBpm']):
+        d = settings.activity_scores(df)
+        cache.store_key_json(activity_id, name, d)
+        scores[activity_id] = d
+
+    index = index.reset_index(drop=True)
+    for score in ('trimp', 'zone_trimp'):
+        index[score] = [scores.get(activity_id, {}).get(score, np.nan)
+                        for activity_id in index['ActivityId']]
+    return index
+
+
+def daily_loads(loads, score=SCORE):
+    '''Sum of the scores per day of the activity start times.'''
+    if len(loads) == 0:
+        return pd.Series([], index=pd.DatetimeIndex([]), dtype=float)
+    days = pd.to_datetime(loads['StartTime']).dt.normalize()
+    return loads[score].fillna(0).groupby(days.values).sum()
+
+
+def update_series(series, daily, end=None):
+    '''Fitness and fatigue curves of daily loads, updating series.
+
+    series is a previous result or None. Days up to the first one whose
+    load changed are kept, the curves are recomputed from there on. The
+    curves run from the first day with a load to end, by default today.
+    '''
+    if end is None:
+        end = pd.Timestamp.now(tz='UTC').tz_localize(None)
+    if len(daily) == 0:
+        return pd.DataFrame(columns=COLUMNS, dtype=float)
+    end = max(pd.Timestamp(end).normalize(), daily.index.max())
+    days = pd.date_range(daily.index.min(), end, freq='D')
+    load = daily.reindex(days, fill_value=0.0).values.astype(float)
+
+    start = 0
+    if series is not None and len(series) and series.index[0] == days[0]:
+        old = series['Load'].reindex(days).values
+        # New days compare as changed, their old load is NaN
+        changed = np.flatnonzero(~np.isclose(old, load))
+        start = changed[0] if len(changed) else len(days)
+    fitness = np.zeros(len(days))
+    fatigue = np.zeros(len(days))
+    if start > 0:
+        fitness[:start] = series['Fitness'].values[:start]
+        fatigue[:start] = series['Fatigue'].values[:start]
+
+    fitness_decay = np.exp(-1.0/FITNESS_DAYS)
+    fatigue_decay = np.exp(-1.0/FATIGUE_DAYS)
+    ctl = fitness[start - 1] if start > 0 else 0.0
+    atl = fatigue[start - 1] if start > 0 else 0.0
+    for i in range(start, len(days)):
+        ctl = ctl*fitness_decay + load[i]*(1 - fitness_decay)
+        atl = atl*fatigue_decay + load[i]*(1 - fatigue_decay)
+        fitness[i] = ctl
+        fatigue[i] = atl
+
+    result = pd.DataFrame({'Load': load, 'Fitness': fitness,
+                           'Fatigue': fatigue, 'Form': fitness - fatigue},
+                          index=days, columns=COLUMNS)
+    result.index.name = 'Date'
+    return result
+
+
+def series_path(store, settings, sport=None, score=SCORE):
+    '''Path of the saved curves, by settings, sport and score.'''
+    return '{0}-{1}-{2}-{3}.h5'.format(
+        os.path.splitext(store.path)[0], settings.score_name(),
+        sport or 'all', score)
+
+
+def load_series(path):
+    '''Saved curves at path, or None.'''
+    if not os.path.exists(path):
+        return None
+    return pd.read_hdf(path, NAME)
+
+
+def get_training_load(store, cache, settings, sport=None, score=SCORE,
+                      end=None, path=None):
+    '''Fitness and fatigue curves of the store, updated and saved.'''
+    if path is None:
+        path = series_path(store, settings, sport, score)
+    loads = activity_loads(store, cache, settings, sport)
+    series = load_series(path)
+    result = update_series(series, daily_loads(loads, score), end)
+    if series is None or not result.equals(series):
+        activity_cache.atomic_write(
+            path, lambda tmp: result.to_hdf(tmp, key=NAME, mode='w'))
+    return result
+
+
+if __name__ == '__main__':
+    import activity_store
+    store = activity_store.ActivityStore(sys.argv[1])
+    cache = parse_tcx.get_cache(sys.argv[2])
+    settings = LoadSettings(*[float(a) for a in sys.argv[3:6]])
+    print(get_training_load(store, cache, settings).tail(14).to_string())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+Checks of the FIT decoder on synthetic FIT files.
+
+Usage: python verify_fit.py [npoints]
+
+Synthetic activities (see synthetic.write_fit) are written with full
+timestamps, with compressed timestamp headers, and with compressed headers
+following timer events, and decoded again. The times and trackpoints must
+match the written ones. Exits with status 1 if any check fails.
+'''
+import io
+import os
+import sys
+import shutil
+import tempfile
+import contextlib
+import numpy as np
+import fit
+import synthetic
+
+
+#: (name, write_fit arguments) of the checked files. Runs of compressed
+#: headers are much longer than their 32 s range.
+CASES = [('full timestamps', dict(interval=1.0)),
+         ('compressed timestamps', dict(interval=5.0, compressed=True)),
+         ('compressed after events', dict(interval=40.0, compressed=True,
+                                          events=True))]
+
+
+def check(filename, npoints, interval):
+    '''Problems found decoding a synthetic FIT file, an empty list if none.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = fit.load_fit_data(filename)
+    problems = []
+    if len(df) != npoints:
+        problems.append('{0} records instead of {1}'.format(len(df),
+                                                            npoints))
+    elif not np.array_equal(df['SecondsElapsed'].values,
+                            interval*np.arange(npoints)):
+        problems.append('times decoded wrong')
+    expected = synthetic.activity_arrays('Running', npoints, interval)
+    if len(df) == npoints and not np.allclose(
+            df['HeartRateBpm'].values, expected['HeartRateBpm']):
+        problems.append('heart rate decoded wrong')
+    return problems
+
+
+def main(npoints=600):
+    directory = tempfile.mkdtemp()
+    failed = 0
+    try:
+        for name, kwargs in CASES:
+            filename = synthetic.write_fit(
+                os.path.join(directory, 'run.fit'), 'Running', npoints,
+                **kwargs)
+            problems = check(filename, npoints, kwargs['interval'])
+            print('{0}: {1}'.format(name, '; '.join(problems) or 'ok'))
+            failed += bool(problems)
+    finally:
+        shutil.rmtree(directory)
+    return failed
+
+
+if __name__ == '__main__':
+    npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    sys.exit(1 if main(npoints) else 0)